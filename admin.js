@@ -133,14 +133,16 @@ class AdminManager {
        try {
         const response = await fetch('/api/documents/upload', {
             method: 'POST',
+            headers: this.authHeaders(),
             body: formData
         });
         
         const data = await response.json();
         
         if (response.ok) {
-            alert(`${file.name} uploaded successfully!`);
+            alert(`${file.name} uploaded, processing started`);
             this.loadDocuments(); // Refresh the list
+            this.pollStatus(data.job_id, file.name);
         } else {
             alert(`❌ Upload failed: ${data.detail}`);
         }
@@ -150,6 +152,47 @@ class AdminManager {
       }
     }
     
+    authHeaders() {
+        const token = localStorage.getItem('token');
+        return token ? {'Authorization': `Bearer ${token}`} : {};
+    }
+    
+    // Processing runs in the background; poll until the document is ready
+    async pollStatus(documentId, filename) {
+        try {
+            const response = await fetch(`/api/documents/${documentId}/status`, {
+                headers: this.authHeaders()
+            });
+            if (!response.ok) {
+                // e.g. 401 after the session expired or 404 for a deleted document
+                const data = await response.json().catch(() => ({}));
+                alert(`❌ Could not get the status of ${filename}: ${data.detail || response.status}`);
+                this.loadDocuments();
+                return;
+            }
+            const job = await response.json();
+
+            if (job.status === 'processed') {
+                this.loadDocuments();
+                this.loadStats();
+                return;
+            }
+            if (job.status === 'failed') {
+                alert(`❌ Processing failed for ${filename}: ${job.error}`);
+                this.loadDocuments();
+                return;
+            }
+            
+            const badge = document.querySelector(`.status-badge[data-id="${documentId}"]`);
+            if (badge) {
+                badge.textContent = `${job.status} ${Math.round(job.progress * 100)}%`;
+            }
+        } catch (error) {
+            console.error('Status error:', error);
+        }
+        setTimeout(() => this.pollStatus(documentId, filename), 1000);
+    }
+    
 
     async loadDocuments() {
         try {
@@ -222,8 +265,8 @@ class AdminManager {
                 <td>${doc.chunks}</td>
                 <td>${new Date(doc.uploaded_at).toLocaleDateString()}</td>
                 <td>
-                    <span class="status-badge ${doc.processed ? 'status-success' : 'status-processing'}">
-                        ${doc.processed ? 'Processed' : 'Processing'}
+                    <span class="status-badge ${doc.processed ? 'status-success' : 'status-processing'}" data-id="${doc.id}">
+                        ${doc.processed ? 'Processed' : (doc.status === 'failed' ? 'Failed' : 'Processing')}
                     </span>
                 </td>
                 <td>
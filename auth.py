@@ -1,12 +1,21 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import event, or_, select
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
-from app.config import config
-from app.database import get_db, User
+from app.config import config, logger
+from app.metrics import metrics
+from app.database import SessionLocal, User
+from app.structured_logging import set_user
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
@@ -17,6 +26,44 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+class PasswordPoolBusy(Exception):
+    pass
+
+class PasswordPool:
+    """Runs bcrypt hashing and verification off the event loop.
+
+    bcrypt releases the GIL, so `workers` threads use at most that many
+    cores and the rest stay free for chat. Past `max_queue` waiting calls
+    new ones are refused instead of queueing without bound.
+    """
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password")
+        self.in_flight = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def depth(self):
+        """Calls waiting for a worker"""
+        return max(0, self.in_flight - self.workers)
+
+    async def run(self, func, *args):
+        with self.lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                logger.warning(f"Password pool full ({self.in_flight} in flight), rejecting request")
+                raise PasswordPoolBusy("Too many login requests")
+            self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+password_pool = PasswordPool(config.PASSWORD_WORKERS, config.PASSWORD_MAX_QUEUE)
+
 def create_access_token(data, expires_delta=None):
     to_encode = data.copy()
     
@@ -29,43 +76,137 @@ def create_access_token(data, expires_delta=None):
     encoded_jwt = jwt.encode(to_encode, config.SECRET_KEY, algorithm=config.ALGORITHM)
     return encoded_jwt
 
-def authenticate_user(db, username, password):
-    user = db.query(User).filter(User.username == username).first()
-    if not user:
-        user = db.query(User).filter(User.email == username).first()
+async def authenticate_user(db, username, password):
+    result = await db.execute(
+        select(User).filter(or_(User.username == username, User.email == username)).limit(1)
+    )
+    user = result.scalars().first()
+    # Hand the connection back before a possibly queued bcrypt check
+    await db.close()
     
     if not user:
         return False
     
-    if not verify_password(password, user.password_hash):
+    if not await password_pool.run(verify_password, password, user.password_hash):
         return False
     
     return user
 
-def get_current_user(credentials = Depends(security), db = Depends(get_db)):
+UserSnapshot = namedtuple("UserSnapshot", ["id", "username", "email"])
+
+class TokenCache:
+    """Bounded TTL cache of verified tokens to the user they belong to.
+
+    A hit skips both JWT verification and the user query. Entries live for
+    at most `ttl` seconds and never past the token's own expiry. Changing
+    or deleting a user drops their entries; the generation check stops a
+    lookup that raced with such a change from caching the old record.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.user_tokens = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(token)
+                return None
+            self.entries.move_to_end(token)
+            return entry[1]
+
+    def generation(self, user_id):
+        return self.generations.get(user_id, 0)
+
+    def put(self, token, user, expires_at, generation):
+        with self.lock:
+            if self.generations.get(user.id, 0) != generation:
+                return
+            if token in self.entries:
+                self._drop(token)
+            self.entries[token] = (min(expires_at, time.time() + self.ttl), user)
+            self.user_tokens.setdefault(user.id, set()).add(token)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            for token in self.user_tokens.pop(user_id, ()):
+                self.entries.pop(token, None)
+
+    def _drop(self, token):
+        _, user = self.entries.pop(token)
+        tokens = self.user_tokens.get(user.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.user_tokens[user.id]
+
+token_cache = TokenCache(config.AUTH_CACHE_SIZE, config.AUTH_CACHE_TTL)
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, target):
+    token_cache.invalidate_user(target.id)
+
+def load_user(payload):
+    """User for a verified token, by id when the token carries one"""
+    db = SessionLocal()
+    try:
+        user_id = payload.get("uid")
+        if user_id is not None:
+            user = db.get(User, user_id)
+        else:
+            # Tokens issued before they carried the user id
+            username = payload.get("sub")
+            user = db.query(User).filter(
+                or_(User.username == username, User.email == username)
+            ).first() if username else None
+        if user is None:
+            return None
+        return UserSnapshot(user.id, user.username, user.email)
+    finally:
+        db.close()
+
+async def get_current_user(credentials = Depends(security)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    token = credentials.credentials
+    user = token_cache.get(token)
+    if user is not None:
+        metrics.inc("auth_cache_total", result="hit")
+        set_user(user.id)
+        return user
+    
+    metrics.inc("auth_cache_total", result="miss")
+    start = time.perf_counter()
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        username = payload.get("sub")
-        
-        if username is None:
-            raise credentials_exception
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
-        user = db.query(User).filter(User.email == username).first()
-    
+    generation = token_cache.generation(payload.get("uid"))
+    user = await run_in_threadpool(load_user, payload)
     if user is None:
         raise credentials_exception
     
+    if payload.get("uid") is None:
+        generation = token_cache.generation(user.id)
+    token_cache.put(token, user, payload.get("exp", 0), generation)
+    metrics.stage("auth.load_user", time.perf_counter() - start)
+    set_user(user.id)
     return user
 
 def create_test_user(db):
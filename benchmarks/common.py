@@ -0,0 +1,149 @@
+"""Shared pieces of the benchmarks: an isolated app environment, a
+deterministic synthetic corpus, latency summaries and JSON result files.
+
+Run the benchmarks from the directory that contains app/, the same place
+the server is started from, e.g. `python -m app.benchmarks.load_test`.
+"""
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+PERCENTILES = (50, 90, 95, 99)
+
+WORDS = (
+    "pump valve sensor pressure flow filter motor bearing seal gasket "
+    "voltage current relay fuse breaker switch panel circuit wiring ground "
+    "invoice payment refund pricing discount contract renewal license plan "
+    "server cluster replica backup restore latency throughput cache queue "
+    "error code reset warning alarm fault diagnostic firmware update patch "
+    "install configure calibrate inspect replace tighten clean lubricate "
+    "monthly weekly daily annual schedule maintenance service warranty "
+    "customer support ticket escalation response policy procedure manual"
+).split()
+
+def isolated_env(prefix="rag-bench-"):
+    """Point the database, uploads and indexes at a fresh temp directory.
+
+    Must run before anything imports app.config. Returns the directory.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    os.environ["DATA_DIR"] = os.path.join(workdir, "data")
+    # Always answer from the mock model, never a paid API
+    os.environ["OPENAI_API_KEY"] = ""
+    os.environ.pop("LLM_BASE_URL", None)
+    return workdir
+
+class Corpus:
+    """Seeded synthetic documents and queries.
+
+    Words follow a Zipf-like distribution, and every document carries a
+    few rare marker terms, so queries sampled from a document have
+    something specific to retrieve.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.weights = [1 / rank for rank in range(1, len(WORDS) + 1)]
+
+    def sentence(self, length=None):
+        words = self.random.choices(WORDS, self.weights, k=length or self.random.randint(8, 20))
+        return " ".join(words).capitalize() + "."
+
+    def document(self, size):
+        """About `size` characters of text in paragraphs"""
+        markers = [f"{self.random.choice(WORDS)}-{self.random.randint(1000, 9999)}" for _ in range(3)]
+        paragraphs = []
+        total = 0
+        while total < size:
+            sentences = [self.sentence() for _ in range(self.random.randint(3, 7))]
+            if self.random.random() < 0.3:
+                sentences.append(f"See {self.random.choice(markers)} for details.")
+            paragraph = " ".join(sentences)
+            paragraphs.append(paragraph)
+            total += len(paragraph) + 2
+        return "\n\n".join(paragraphs)
+
+    def query(self, text):
+        """A short question built from words of `text`"""
+        words = text.split()
+        start = self.random.randrange(max(len(words) - 6, 1))
+        terms = " ".join(word.strip(".,").lower() for word in words[start:start + self.random.randint(3, 6)])
+        return f"What does the manual say about {terms}?"
+
+def summarize(latencies, errors=0, elapsed=None, statuses=None):
+    """Count, throughput and latency percentiles (ms) for one operation"""
+    latencies = sorted(latencies)
+    summary = {"requests": len(latencies) + errors, "errors": errors}
+    if statuses is not None:
+        summary["statuses"] = {str(status): count for status, count in sorted(statuses.items())}
+    if elapsed:
+        summary["elapsed_s"] = round(elapsed, 3)
+        summary["throughput_per_s"] = round(len(latencies) / elapsed, 2)
+    if latencies:
+        summary["latency_ms"] = {
+            "mean": round(1000 * sum(latencies) / len(latencies), 3),
+            "min": round(1000 * latencies[0], 3),
+            **{f"p{p}": round(1000 * percentile(latencies, p), 3) for p in PERCENTILES},
+            "max": round(1000 * latencies[-1], 3)
+        }
+    return summary
+
+def percentile(ordered, p):
+    """Linear interpolation between closest ranks of a sorted list"""
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def time_op(func, repeat, number=1):
+    """Seconds per call of `func` for each of `repeat` runs of `number` calls"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True,
+            text=True,
+            timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def write_results(path, benchmark, params, results):
+    """Write one run as JSON; the environment is recorded so runs can be compared"""
+    report = {
+        "benchmark": benchmark,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "results": results
+    }
+    if path == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {path}", file=sys.stderr)
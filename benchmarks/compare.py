@@ -0,0 +1,70 @@
+"""Compare two benchmark result files metric by metric.
+
+    python -m app.benchmarks.compare bench-results/before.json bench-results/after.json
+"""
+import argparse
+import json
+
+# Leaf names where a higher number is better; for everything else lower is
+HIGHER_IS_BETTER = {"throughput_per_s", "items_per_s", "documents_per_s", "chunks_per_s"}
+SKIP = {"requests", "errors", "items", "count", "characters", "chunks", "concurrency", "elapsed_s"}
+
+def flatten(value, path=""):
+    """Numeric leaves keyed by a dotted path; lists of runs are keyed by
+    their concurrency or size, so runs with different settings line up"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, dict):
+                label = next((f"{key}={item[key]}" for key in ("concurrency", "chunks") if key in item), index)
+            else:
+                label = index
+            yield from flatten(item, f"{path}[{label}]")
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path, value
+
+def compare(before, after, threshold):
+    old = dict(flatten(before["results"]))
+    new = dict(flatten(after["results"]))
+    rows = []
+    for path, value in new.items():
+        leaf = path.rsplit(".", 1)[-1]
+        if path not in old or leaf in SKIP or "statuses" in path:
+            continue
+        previous = old[path]
+        change = (value - previous) / previous * 100 if previous else 0.0
+        better = change > 0 if leaf in HIGHER_IS_BETTER else change < 0
+        flag = "" if abs(change) < threshold else ("better" if better else "WORSE")
+        rows.append((path, previous, value, change, flag))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=5.0, help="percent change worth flagging")
+    parser.add_argument("--changed", action="store_true", help="only show flagged metrics")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    if before.get("benchmark") != after.get("benchmark"):
+        parser.error(f"{args.before} is a {before.get('benchmark')} run, {args.after} is {after.get('benchmark')}")
+    for key in ("revision", "cpus", "python"):
+        if before.get(key) != after.get(key):
+            print(f"note: {key} differs ({before.get(key)} -> {after.get(key)})")
+
+    rows = compare(before, after, args.threshold)
+    width = max((len(row[0]) for row in rows), default=0)
+    for path, previous, value, change, flag in rows:
+        if args.changed and not flag:
+            continue
+        print(f"{path:<{width}}  {previous:>12g}  {value:>12g}  {change:+7.1f}%  {flag}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""In-process load test of the upload, chat, history and search paths.
+
+Starts app.main:app inside this process against a temp SQLite database
+and the mock LLM. It creates synthetic users and documents, uploads and
+ingests them, and then drives /api/chat, /api/chat/history and
+search_documents at each requested concurrency. Throughput, latency
+percentiles and per-stage timings are written as JSON.
+
+    python -m app.benchmarks.load_test --users 20 --docs 5 --concurrency 1 8 32
+
+Rate limits and the daily token budget are lifted unless --keep-limits
+is given, so the numbers describe the service rather than the limiter.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+from app.benchmarks.common import Corpus, isolated_env, summarize, write_results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--docs", type=int, default=3, help="documents per user")
+    parser.add_argument("--doc-size", type=int, default=20_000, help="characters per document")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--upload-concurrency", type=int, default=4)
+    parser.add_argument("--chat-requests", type=int, default=200)
+    parser.add_argument("--history-requests", type=int, default=200)
+    parser.add_argument("--history-limit", type=int, default=50)
+    parser.add_argument("--search-requests", type=int, default=500)
+    parser.add_argument("--llm-ttft", type=float, help="mock LLM time to first token, seconds")
+    parser.add_argument("--llm-token-delay", type=float, help="mock LLM delay per token, seconds")
+    parser.add_argument("--keep-limits", action="store_true", help="leave rate limits and token budgets on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file to write, or - for stdout")
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO logging")
+    return parser.parse_args(argv)
+
+async def drive(operation, count, concurrency):
+    """Call operation(i) for i in range(count) with `concurrency` calls in flight.
+
+    `operation` returns an HTTP status; only 2xx responses count towards
+    the latency percentiles.
+    """
+    latencies = []
+    statuses = Counter()
+    errors = 0
+    indexes = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            start = time.perf_counter()
+            try:
+                status = await operation(i)
+            except Exception as e:
+                errors += 1
+                statuses[type(e).__name__] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            statuses[status] += 1
+            if 200 <= status < 300:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize(latencies, errors, time.perf_counter() - start, statuses)
+
+def stage_counts(metrics):
+    return {
+        dict(labels)["stage"]: list(histogram.counts)
+        for (name, labels), histogram in list(metrics.histograms.items())
+        if name == "stage_seconds"
+    }
+
+def stage_summary(before, after):
+    """Stage percentiles (ms) from the spans recorded between two snapshots"""
+    from app.metrics import Histogram
+
+    stages = {}
+    for stage, counts in sorted(after.items()):
+        previous = before.get(stage, [0] * len(counts))
+        histogram = Histogram()
+        histogram.counts = [now - then for now, then in zip(counts, previous)]
+        histogram.count = sum(histogram.counts)
+        if histogram.count:
+            stages[stage] = {
+                "count": histogram.count,
+                **{f"p{int(q * 100)}": round(1000 * histogram.quantile(q), 3) for q in (0.5, 0.95, 0.99)}
+            }
+    return stages
+
+async def run(args):
+    workdir = isolated_env()
+    if not args.keep_limits:
+        os.environ["DAILY_TOKEN_BUDGET"] = "0"
+
+    from app.config import config
+
+    # Set before app.main is imported, which builds the limiters
+    if not args.keep_limits:
+        config.CHAT_RATE = config.UPLOAD_RATE = 1_000_000
+        config.CHAT_BURST = config.UPLOAD_BURST = 1_000_000
+        config.INGEST_MAX_PER_USER = config.INGEST_MAX_PENDING = args.users * args.docs + 1
+    if args.llm_ttft is not None:
+        config.MOCK_LLM_TTFT = args.llm_ttft
+    if args.llm_token_delay is not None:
+        config.MOCK_LLM_TOKEN_DELAY = args.llm_token_delay
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    import httpx
+    from sqlalchemy import func
+    from starlette.concurrency import run_in_threadpool
+
+    from app.auth import create_access_token, get_password_hash
+    from app.database import SessionLocal, User, Document, DocumentChunk, async_engine
+    from app.document_processor import doc_processor
+    from app.jobs import ingestion_queue
+    from app.main import app
+    from app.metrics import metrics
+
+    corpus = Corpus(args.seed)
+    documents = [
+        [corpus.document(args.doc_size) for _ in range(args.docs)]
+        for _ in range(args.users)
+    ]
+
+    await app.router.startup()
+    try:
+        db = SessionLocal()
+        try:
+            password_hash = get_password_hash("bench-password")
+            users = [
+                User(username=f"bench{i}", email=f"bench{i}@example.com", password_hash=password_hash)
+                for i in range(args.users)
+            ]
+            db.add_all(users)
+            db.commit()
+            users = [(user.id, create_access_token({"sub": user.username, "uid": user.id})) for user in users]
+        finally:
+            db.close()
+        headers = [{"Authorization": f"Bearer {token}"} for _, token in users]
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            results = {}
+
+            async def upload(i):
+                user, number = i % args.users, i // args.users
+                response = await client.post(
+                    "/api/documents/upload",
+                    files={"file": (f"manual-{number}.txt", documents[user][number].encode())},
+                    headers=headers[user]
+                )
+                return response.status_code
+
+            print(f"Uploading {args.users * args.docs} documents", file=sys.stderr)
+            start = time.perf_counter()
+            results["upload"] = await drive(upload, args.users * args.docs, args.upload_concurrency)
+            while ingestion_queue.pending():
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - start
+
+            db = SessionLocal()
+            try:
+                statuses = dict(db.query(Document.status, func.count(Document.id)).group_by(Document.status).all())
+                chunks = db.query(func.count(DocumentChunk.id)).scalar()
+            finally:
+                db.close()
+            results["ingest"] = {
+                "documents": statuses,
+                "chunks": chunks,
+                "elapsed_s": round(elapsed, 3),
+                "documents_per_s": round(statuses.get("processed", 0) / elapsed, 2),
+                "chunks_per_s": round(chunks / elapsed, 2)
+            }
+
+            def query(i):
+                user = i % args.users
+                return user, corpus.query(corpus.random.choice(documents[user]))
+
+            results["runs"] = []
+            for concurrency in args.concurrency:
+                print(f"Concurrency {concurrency}", file=sys.stderr)
+                before = stage_counts(metrics)
+                chat_queries = [query(i) for i in range(args.chat_requests)]
+                search_queries = [query(i) for i in range(args.search_requests)]
+
+                async def chat(i):
+                    user, message = chat_queries[i]
+                    response = await client.post(
+                        "/api/chat",
+                        json={"message": message, "session_id": f"bench-{user}"},
+                        headers=headers[user]
+                    )
+                    return response.status_code
+
+                async def history(i):
+                    user = i % args.users
+                    response = await client.get(
+                        "/api/chat/history",
+                        params={"session_id": f"bench-{user}", "limit": args.history_limit},
+                        headers=headers[user]
+                    )
+                    return response.status_code
+
+                async def search(i):
+                    user, message = search_queries[i]
+                    await run_in_threadpool(
+                        doc_processor.search_documents, message, users[user][0], config.RETRIEVAL_TOP_K
+                    )
+                    return 200
+
+                results["runs"].append({
+                    "concurrency": concurrency,
+                    "chat": await drive(chat, args.chat_requests, concurrency),
+                    "history": await drive(history, args.history_requests, concurrency),
+                    "search_documents": await drive(search, args.search_requests, concurrency),
+                    "stages": stage_summary(before, stage_counts(metrics))
+                })
+    finally:
+        await app.router.shutdown()
+        await async_engine.dispose()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    params = vars(args).copy()
+    params.update({
+        "search_mode": config.SEARCH_MODE,
+        "reranker": config.RERANKER,
+        "embedding_backend": config.EMBEDDING_BACKEND,
+        "mock_llm_ttft": config.MOCK_LLM_TTFT,
+        "mock_llm_token_delay": config.MOCK_LLM_TOKEN_DELAY
+    })
+    return params, results
+
+def main(argv=None):
+    args = parse_args(argv)
+    params, results = asyncio.run(run(args))
+    output = args.output or os.path.join(
+        "bench-results", f"load_test-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    write_results(output, "load_test", params, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Micro-benchmarks for chunking, embedding, indexing and retrieval.
+
+Each step is timed on its own against synthetic text. Nothing here
+starts the app or touches a database.
+
+    python -m app.benchmarks.micro --chunks 1000 10000 --output micro.json
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+from app.benchmarks.common import Corpus, isolated_env, summarize, time_op, write_results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10_000], help="index sizes to test")
+    parser.add_argument("--text-size", type=int, default=1_000_000, help="characters to chunk")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file to write, or - for stdout")
+    return parser.parse_args(argv)
+
+def throughput(timings, items):
+    """Best and median time of repeated runs over `items` items"""
+    timings = sorted(timings)
+    return {
+        "items": items,
+        "best_ms": round(1000 * timings[0], 3),
+        "median_ms": round(1000 * timings[len(timings) // 2], 3),
+        "items_per_s": round(items / timings[0], 1) if timings[0] else None
+    }
+
+def latencies(func, args_list):
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def run(args):
+    workdir = isolated_env()
+    try:
+        from app.config import config
+        from app.context_builder import context_builder
+        from app.document_processor import doc_processor
+        from app.embeddings import get_provider
+        from app.lexical_index import LexicalIndex, reciprocal_rank_fusion
+        from app.reranker import reranker
+        from app.vector_store import VectorIndex
+
+        corpus = Corpus(args.seed)
+        provider = get_provider()
+        results = {}
+
+        print("Chunking", file=sys.stderr)
+        text = corpus.document(args.text_size)
+        blocks = [text[i:i + config.READ_BLOCK_SIZE] for i in range(0, len(text), config.READ_BLOCK_SIZE)]
+        chunks = list(doc_processor.chunk_text(blocks))
+        results["chunk_text"] = {
+            "characters": len(text),
+            **throughput(time_op(lambda: list(doc_processor.chunk_text(blocks)), args.repeat), len(chunks))
+        }
+
+        print("Embedding", file=sys.stderr)
+        batch = chunks[:config.EMBED_BATCH_SIZE]
+        results["embed_batch"] = throughput(time_op(lambda: provider.embed(batch), args.repeat), len(batch))
+
+        results["sizes"] = []
+        for size in args.chunks:
+            print(f"Index of {size} chunks", file=sys.stderr)
+            texts = [chunks[i % len(chunks)] for i in range(size)]
+            ids = [f"bench-{i}" for i in range(size)]
+            vectors = provider.embed(texts)
+            queries = [corpus.query(corpus.random.choice(texts)) for _ in range(args.queries)]
+            query_vectors = provider.embed(queries)
+
+            def build_vectors():
+                shutil.rmtree(os.path.join(workdir, "vectors"), ignore_errors=True)
+                index = VectorIndex(os.path.join(workdir, "vectors"), config.EMBEDDING_DIM)
+                index.add(1, ids, vectors, texts)
+                return index
+
+            def build_lexical():
+                index = LexicalIndex(os.path.join(workdir, "lexical"))
+                index.add(1, ids, texts)
+                return index
+
+            entry = {
+                "chunks": size,
+                "vector_add": throughput(time_op(build_vectors, args.repeat), size),
+                "lexical_add": throughput(time_op(build_lexical, args.repeat), size)
+            }
+            vector_index = build_vectors()
+            lexical_index = build_lexical()
+            depth = max(config.RETRIEVAL_TOP_K, config.RERANK_CANDIDATES)
+
+            entry["vector_search"] = latencies(
+                lambda vector: vector_index.search(1, vector[None, :], depth),
+                [(vector,) for vector in query_vectors]
+            )
+            entry["vector_search_batch"] = throughput(
+                time_op(lambda: vector_index.search(1, query_vectors, depth), args.repeat), len(queries)
+            )
+            entry["lexical_search"] = latencies(
+                lambda query: lexical_index.search(1, query, depth),
+                [(query,) for query in queries]
+            )
+
+            def hybrid(query, vector):
+                dense = vector_index.search(1, vector[None, :], depth)[0]
+                lexical = lexical_index.search(1, query, depth)
+                return reciprocal_rank_fusion([dense, lexical])[:depth]
+
+            entry["hybrid_search"] = latencies(hybrid, list(zip(queries, query_vectors)))
+
+            text_by_id = dict(zip(ids, texts))
+            candidates = [
+                [{"text": text_by_id[embedding_id], "metadata": {}, "score": score}
+                 for embedding_id, score in hybrid(query, vector)]
+                for query, vector in zip(queries, query_vectors)
+            ]
+            if reranker:
+                entry["rerank"] = latencies(
+                    lambda query, docs: reranker.rerank(query, docs, config.RETRIEVAL_TOP_K),
+                    list(zip(queries, candidates))
+                )
+            entry["build_context"] = latencies(
+                lambda query, docs: context_builder.build(query, docs[:config.RETRIEVAL_TOP_K]),
+                list(zip(queries, candidates))
+            )
+            results["sizes"].append(entry)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    params = vars(args).copy()
+    params.update({
+        "chunk_size": config.CHUNK_SIZE,
+        "chunk_overlap": config.CHUNK_OVERLAP,
+        "embedding_backend": config.EMBEDDING_BACKEND,
+        "embedding_dim": config.EMBEDDING_DIM,
+        "reranker": config.RERANKER
+    })
+    return params, results
+
+def main(argv=None):
+    args = parse_args(argv)
+    params, results = run(args)
+    output = args.output or os.path.join(
+        "bench-results", f"micro-{datetime.utcnow():%Y%m%d-%H%M%S}.json"
+    )
+    write_results(output, "micro", params, results)
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ document.addEventListener('DOMContentLoaded', function() {
     
     console.log('Elements found');
     
+    let sessionId = null;
+    
     async function sendMessage() {
         const text = input.value.trim();
         if (!text) return;
@@ -24,15 +26,46 @@ document.addEventListener('DOMContentLoaded', function() {
         const typingId = addTyping();
         
         try {
-            const response = await fetch('/api/chat', {
+            const headers = {'Content-Type': 'application/json'};
+            const token = localStorage.getItem('token');
+            if (token) headers['Authorization'] = `Bearer ${token}`;
+            
+            const response = await fetch('/api/chat/stream', {
                 method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({message: text})
+                headers: headers,
+                body: JSON.stringify({message: text, session_id: sessionId || undefined})
             });
             
-            const data = await response.json();
-            removeTyping(typingId);
-            addMessage(data.response || 'No response', 'bot');
+            if (!response.ok || !response.body) {
+                const data = await response.json().catch(() => ({}));
+                removeTyping(typingId);
+                addMessage(data.detail || 'No response', 'bot');
+                return;
+            }
+            
+            // Render tokens as they arrive instead of waiting for the full answer
+            let textEl = null;
+            await readEvents(response.body, (event, data) => {
+                if (event === 'done') {
+                    sessionId = data.session_id;
+                    return;
+                }
+                if (!textEl) {
+                    removeTyping(typingId);
+                    textEl = addMessage('', 'bot');
+                }
+                if (event === 'error') {
+                    textEl.textContent += `\nError: ${data.detail}`;
+                } else {
+                    textEl.textContent += data.token;
+                }
+                messages.scrollTop = messages.scrollHeight;
+            });
+            
+            if (!textEl) {
+                removeTyping(typingId);
+                addMessage('No response', 'bot');
+            }
             
         } catch (error) {
             removeTyping(typingId);
@@ -40,6 +73,32 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    async function readEvents(body, onEvent) {
+        const reader = body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const {value, done} = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, {stream: true});
+            
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const raw = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                
+                let event = 'message';
+                let data = '';
+                raw.split('\n').forEach(line => {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                });
+                if (data) onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+    
     function addMessage(text, sender) {
         const div = document.createElement('div');
         div.className = `message ${sender}`;
@@ -48,12 +107,16 @@ document.addEventListener('DOMContentLoaded', function() {
                 <i class="fas fa-${sender === 'user' ? 'user' : 'robot'}"></i>
             </div>
             <div class="message-content">
-                <div class="message-text">${text}</div>
+                <div class="message-text"></div>
                 <div class="message-time">${new Date().toLocaleTimeString()}</div>
             </div>
         `;
+        const textEl = div.querySelector('.message-text');
+        textEl.style.whiteSpace = 'pre-wrap';
+        textEl.textContent = text;
         messages.appendChild(div);
         messages.scrollTop = messages.scrollHeight;
+        return textEl;
     }
     
     function addTyping() {
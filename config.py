@@ -2,27 +2,114 @@ import os
 import logging
 from dotenv import load_dotenv
 
+from app.structured_logging import setup_logging
+
 load_dotenv()
 
 class AppConfig:
     SECRET_KEY = os.getenv("SECRET_KEY", "dev_key_temp")
     ALGORITHM = "HS256"
+    TOKEN_EXPIRE_HOURS = 24
+    AUTH_CACHE_SIZE = 10_000
+    AUTH_CACHE_TTL = 300
+    PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+    PASSWORD_MAX_QUEUE = 64
     DB_URL = os.getenv("DATABASE_URL", "sqlite:///chatbot.db")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = 30
+    # Create tables and the demo user on start; scale-out replicas can skip it
+    DB_BOOTSTRAP = os.getenv("DB_BOOTSTRAP", "1") == "1"
     OPENAI_KEY = os.getenv("OPENAI_API_KEY", "")
     AI_MODEL = "gpt-3.5-turbo"
-    UPLOAD_DIR = "uploads"
+    MODEL_CONTEXT_WINDOW = 16385
+    MAX_OUTPUT_TOKENS = 512
+    CONTEXT_TOKEN_BUDGET = 3000
+    HISTORY_TOKEN_BUDGET = 1000
+    RETRIEVAL_TOP_K = 8
+    UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
     ALLOWED_FILES = {'txt', 'pdf', 'md'}
     MAX_SIZE = 16 * 1024 * 1024
+    UPLOAD_BLOCK_SIZE = 1024 * 1024
     CHUNK_SIZE = 800
     CHUNK_OVERLAP = 150
+    READ_BLOCK_SIZE = 64 * 1024
+    CHUNK_INSERT_BATCH = 1000
+    PDF_PARALLEL_PAGES = 100
+    PDF_PAGES_PER_TASK = 25
+    DATA_DIR = os.getenv("DATA_DIR", "data")
+    VECTOR_DIR = os.path.join(DATA_DIR, "vectors")
+    RUN_DIR = os.path.join(DATA_DIR, "run")
+    VECTOR_SEGMENT_ROWS = 65_536
+    VECTOR_COMPACT_RATIO = 0.3
+    EMBEDDING_DIM = 128
+    EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "hashing")
+    EMBEDDING_MODEL = "text-embedding-3-small"
+    EMBED_BATCH_SIZE = 256
+    EMBED_CACHE_SIZE = 100_000
+    EMBED_MICROBATCH_SIZE = 64
+    EMBED_MICROBATCH_WAIT = 0.005
+    LEXICAL_DIR = os.path.join(DATA_DIR, "lexical")
+    LEXICAL_MAX_DF = 0.25
+    LEXICAL_PRUNE_MIN_ROWS = 1000
+    LEXICAL_IMPACT_DEPTH = 1000
+    LEXICAL_COMPACT_RATIO = 0.3
+    SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+    RRF_K = 60
+    RERANKER = os.getenv("RERANKER", "overlap")
+    RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    RERANK_CANDIDATES = 100
+    RERANK_BATCH_SIZE = 32
+    RERANK_BUDGET_MS = 30
+    HISTORY_PAGE_SIZE = 50
+    HISTORY_MAX_PAGE_SIZE = 500
+    SESSION_MEMORY_SESSIONS = 10_000
+    SESSION_MEMORY_TURNS = 5
+    SESSION_PREVIEW_CHARS = 200
+    RESPONSE_CACHE_SIZE = 10_000
+    RESPONSE_CACHE_TTL = 3600
+    RESPONSE_CACHE_SIMILARITY = 0.85
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+    # Every ingest worker has its own PDF pool, so the cores are split between
+    # them, but a pool keeps at least two so a long PDF is still read in parallel
+    PDF_WORKERS = int(os.getenv("PDF_WORKERS", max(2, (os.cpu_count() or 1) // INGEST_WORKERS)))
+    INGEST_MAX_PENDING = 100
+    INGEST_NICE = 5
+    INGEST_MAX_PER_USER = 10
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    CHAT_RATE = 1.0
+    CHAT_BURST = 10
+    UPLOAD_RATE = 0.2
+    UPLOAD_BURST = 10
+    CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", 32))
+    CHAT_USER_CONCURRENCY = 2
+    CHAT_USER_QUEUE = 8
+    DAILY_TOKEN_BUDGET = int(os.getenv("DAILY_TOKEN_BUDGET", 200_000))
     USE_MOCK = not bool(OPENAI_KEY)
+    PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", 0))
+    WARMUP_ON_START = os.getenv("WARMUP_ON_START", "0") == "1"
+    LOG_DIR = os.getenv("LOG_DIR", "logs")
+    LOG_FILE = "app.log"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUPS = 5
+    LOG_QUEUE_SIZE = 10_000
+    LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", 0.01))
+    LLM_BASE_URL = os.getenv("LLM_BASE_URL", "")
+    LLM_MAX_CONNECTIONS = 100
+    LLM_KEEPALIVE = 60
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+    LLM_TIMEOUT = 60
+    LLM_CONNECT_TIMEOUT = 5
+    LLM_RETRIES = 3
+    LLM_BACKOFF_BASE = 0.5
+    LLM_BACKOFF_MAX = 8
+    MOCK_LLM_TTFT = float(os.getenv("MOCK_LLM_TTFT", 0.3))
+    MOCK_LLM_TOKEN_DELAY = float(os.getenv("MOCK_LLM_TOKEN_DELAY", 0.02))
 
 config = AppConfig()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(message)s',
-    handlers=[logging.FileHandler('logs/app.log'), logging.StreamHandler()]
-)
+setup_logging(config)
 
 logger = logging.getLogger(__name__)
\ No newline at end of file
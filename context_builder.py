@@ -0,0 +1,183 @@
+import re
+import threading
+
+from app.config import config, logger
+
+WORD_RE = re.compile(r"\w+|[^\w\s]")
+MIN_OVERLAP = 20
+
+class Tokenizer:
+    """Counts tokens the way the chat model does.
+
+    Uses tiktoken when it is installed; otherwise words and punctuation
+    marks are counted, which is close for English prose.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.encoding = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Load the encoding on first use; reading the BPE ranks takes a while"""
+        with self.lock:
+            if self.loaded:
+                return self.encoding
+            try:
+                import tiktoken
+            except ImportError:
+                logger.warning("tiktoken is not installed, estimating token counts")
+            else:
+                try:
+                    self.encoding = tiktoken.encoding_for_model(self.model)
+                except KeyError:
+                    self.encoding = tiktoken.get_encoding("cl100k_base")
+            self.loaded = True
+            return self.encoding
+
+    def count(self, text):
+        encoding = self.encoding if self.loaded else self.load()
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return len(WORD_RE.findall(text))
+
+    def truncate(self, text, max_tokens):
+        encoding = self.encoding if self.loaded else self.load()
+        if encoding is not None:
+            return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+        words = WORD_RE.finditer(text)
+        for i, match in enumerate(words):
+            if i == max_tokens:
+                return text[:match.start()].rstrip()
+        return text
+
+def overlap_length(before, after, limit):
+    """Length of the longest suffix of `before` (within `limit` chars) that `after` starts with"""
+    tail = before[-limit:]
+    probe = after[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    pos = tail.find(probe)
+    while pos != -1:
+        if after.startswith(tail[pos:]):
+            return len(tail) - pos
+        pos = tail.find(probe, pos + 1)
+    return 0
+
+class ContextBuilder:
+    """Packs retrieved chunks and recent turns into a prompt within a token budget.
+
+    Chunks are taken in rank order while they fit in `context_budget`.
+    Text a chunk shares with a neighbouring chunk of the same document that
+    is already in the prompt is cut, and exact duplicates are skipped.
+    Recent turns then fill `history_budget`, newest first. The whole prompt
+    is kept within the model's context window less room for the answer.
+    """
+
+    # Per-message framing tokens in the chat format
+    MESSAGE_OVERHEAD = 4
+    PROMPT_OVERHEAD = 3
+
+    SYSTEM_PROMPT = (
+        "You are a helpful assistant. Answer the user's question using the "
+        "document excerpts below. If they do not contain the answer, say so."
+    )
+
+    def __init__(self, tokenizer, context_window, max_output_tokens, context_budget, history_budget):
+        self.tokenizer = tokenizer
+        self.prompt_limit = context_window - max_output_tokens
+        self.context_budget = context_budget
+        self.history_budget = history_budget
+
+    def build(self, query, context, chat_history=None):
+        count = self.tokenizer.count
+        used = (
+            self.PROMPT_OVERHEAD
+            + 2 * self.MESSAGE_OVERHEAD
+            + count(self.SYSTEM_PROMPT)
+            + count(query)
+        )
+
+        budget = min(self.context_budget, self.prompt_limit - used)
+        selected = self._select_chunks(context or [], budget)
+        context_tokens = sum(doc['tokens'] for doc in selected)
+        used += context_tokens
+
+        budget = min(self.history_budget, self.prompt_limit - used)
+        history = []
+        for turn in reversed(chat_history or []):
+            tokens = count(turn["message"]) + self.MESSAGE_OVERHEAD
+            if tokens > budget:
+                break
+            budget -= tokens
+            used += tokens
+            history.append({
+                "role": "user" if turn["is_user"] else "assistant",
+                "content": turn["message"]
+            })
+        history.reverse()
+
+        system = self.SYSTEM_PROMPT
+        if selected:
+            excerpts = "\n\n".join(
+                f"[{i}] ({doc['metadata'].get('filename')}) {doc['text']}"
+                for i, doc in enumerate(selected, 1)
+            )
+            system = f"{system}\n\nDocument excerpts:\n{excerpts}"
+
+        messages = [{"role": "system", "content": system}, *history, {"role": "user", "content": query}]
+        return {
+            "query": query,
+            "messages": messages,
+            "context": selected,
+            "prompt_tokens": self.PROMPT_OVERHEAD + sum(
+                count(message["content"]) + self.MESSAGE_OVERHEAD for message in messages
+            )
+        }
+
+    def _select_chunks(self, context, budget):
+        selected = []
+        placed = {}
+        seen = set()
+        limit = 2 * config.CHUNK_OVERLAP
+        for doc in context:
+            text = doc['text']
+            if text in seen:
+                continue
+            metadata = doc['metadata']
+            document_id = metadata.get('document_id')
+            index = metadata.get('chunk_index')
+            if index is not None:
+                before = placed.get((document_id, index - 1))
+                if before is not None:
+                    text = text[overlap_length(before, text, limit):].lstrip()
+                after = placed.get((document_id, index + 1))
+                if after is not None:
+                    text = text[:len(text) - overlap_length(text, after, limit)].rstrip()
+            if not text:
+                continue
+
+            tokens = self.tokenizer.count(text) + 2
+            if tokens > budget:
+                if selected or budget <= 0:
+                    continue
+                # The best chunk alone is over budget: keep as much of it as fits
+                text = self.tokenizer.truncate(text, budget - 2)
+                tokens = budget
+
+            budget -= tokens
+            seen.add(doc['text'])
+            placed[(document_id, index)] = doc['text']
+            selected.append({**doc, 'text': text, 'tokens': tokens})
+        return selected
+
+tokenizer = Tokenizer(config.AI_MODEL)
+
+context_builder = ContextBuilder(
+    tokenizer,
+    config.MODEL_CONTEXT_WINDOW,
+    config.MAX_OUTPUT_TOKENS,
+    config.CONTEXT_TOKEN_BUDGET,
+    config.HISTORY_TOKEN_BUDGET
+)
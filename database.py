@@ -1,16 +1,57 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, UniqueConstraint, Integer, String, DateTime, Text, Boolean, ForeignKey
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
 
 from app.config import config
 
+IS_SQLITE = config.DB_URL.startswith("sqlite")
+
+# INSERT ... ON CONFLICT for the configured database
+upsert = sqlite_insert if IS_SQLITE else postgresql_insert
+
+def async_url(url):
+    """Map DATABASE_URL to its async driver: aiosqlite for SQLite, asyncpg for Postgres"""
+    if url.startswith("sqlite:"):
+        return url.replace("sqlite:", "sqlite+aiosqlite:", 1)
+    for prefix in ("postgresql+psycopg2:", "postgresql:", "postgres:"):
+        if url.startswith(prefix):
+            return url.replace(prefix, "postgresql+asyncpg:", 1)
+    return url
+
 engine = create_engine(
     config.DB_URL,
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False} if IS_SQLITE else {}
+)
+
+# Used by the async request handlers; the sync engine above stays for
+# ingestion workers and the other sync code paths
+async_engine = create_async_engine(
+    async_url(config.DB_URL),
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_timeout=config.DB_POOL_TIMEOUT,
+    pool_pre_ping=not IS_SQLITE
 )
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets chat reads continue while ingestion workers write chunks
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+if IS_SQLITE:
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class User(Base):
@@ -35,10 +76,17 @@ class Document(Base):
     original_filename = Column(String(255))
     file_type = Column(String(10))
     file_size = Column(Integer)
-    content = Column(Text)
+    content_hash = Column(String(64), index=True)
+    # Distinct chunks; a chunk repeated within the document is stored once
     chunk_count = Column(Integer, default=0)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     is_processed = Column(Boolean, default=False)
+    status = Column(String(20), default="queued")
+    error = Column(Text)
+    # Ingestion queue that owns the document while it is processing
+    owner = Column(String(100))
+    # JSON of the processed version a re-upload replaces, restored if the new one fails
+    previous_version = Column(Text)
     
     user = relationship("User", back_populates="documents")
     chunks = relationship("DocumentChunk", back_populates="document")
@@ -47,10 +95,14 @@ class DocumentChunk(Base):
     __tablename__ = "document_chunks"
     
     id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id"))
+    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
     chunk_index = Column(Integer)
     chunk_text = Column(Text)
-    embedding_id = Column(String(100))
+    content_hash = Column(String(40))
+    embedding_id = Column(String(100), index=True)
+    # Position in the version of the document being processed; rows only
+    # that version has get no chunk_index until it is processed
+    next_index = Column(Integer)
     
     document = relationship("Document", back_populates="chunks")
 
@@ -67,13 +119,70 @@ class ChatHistory(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     user = relationship("User", back_populates="chats")
+    
+    # Keyset pagination of /api/chat/history, with and without a session filter
+    __table_args__ = (
+        Index("ix_chat_history_user_session_created", "user_id", "session_id", "created_at", "id"),
+        Index("ix_chat_history_user_created", "user_id", "created_at", "id"),
+    )
+
+class ChatSession(Base):
+    """Running summary of a chat session, updated with every turn"""
+    __tablename__ = "chat_sessions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    session_id = Column(String(100))
+    title = Column(String(255))
+    last_message = Column(Text)
+    message_count = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint("user_id", "session_id", name="uq_chat_sessions_user_session"),
+        Index("ix_chat_sessions_user_updated", "user_id", "updated_at"),
+    )
+
+def upgrade_schema():
+    """Bring tables created by an earlier version up to the current models.
+
+    create_all only creates missing tables, so columns and indexes added
+    to existing tables since are added here. Safe to run on every start.
+    """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=conn.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    if table.name == "documents" and column.name == "status":
+                        # Earlier versions processed uploads inline, so an unprocessed document had failed
+                        conn.execute(text(
+                            "UPDATE documents SET status = CASE WHEN is_processed THEN 'processed' ELSE 'failed' END"
+                        ))
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(bind=conn)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    upgrade_schema()
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
\ No newline at end of file
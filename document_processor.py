@@ -1,49 +1,558 @@
+import hashlib
+import json
 import os
+from datetime import datetime
+import numpy as np
+from sqlalchemy import bindparam, func, insert, or_, select, update
+from starlette.concurrency import run_in_threadpool
+
 from app.config import config, logger
-from app.database import Document, SessionLocal
+from app.database import Document, DocumentChunk, SessionLocal
+from app.embeddings import embedder
+from app.extractors import EXTRACTORS, ExtractionError
+from app.lexical_index import lexical_index, reciprocal_rank_fusion
+from app.metrics import metrics
+from app.micro_batcher import query_batcher
+from app.reranker import reranker
+from app.response_cache import response_cache
+from app.vector_store import vector_index
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(config.UPLOAD_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Preferred cut points, best first: paragraph, sentence, line, word
+BREAKS = ("\n\n", ". ", "! ", "? ", "\n", " ")
 
 class DocumentProcessor:
     def __init__(self):
         logger.info("DocumentProcessor ready")
-    
+
+    def iter_text(self, file_path, file_type):
+        """Yield the document text in blocks (a page at a time for PDFs)"""
+        extractor = EXTRACTORS.get(file_type)
+        if extractor is None:
+            raise ExtractionError(f"No extractor for .{file_type} files")
+        return extractor(file_path)
+
     def extract_text(self, file_path, file_type):
-        try:
-            if file_type == "txt":
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return f.read()
+        return "".join(self.iter_text(file_path, file_type))
+
+    def chunk_text(self, blocks, chunk_size=None, overlap=None):
+        """Cut a stream of text blocks into overlapping chunks.
+
+        Only the unconsumed tail of the previous block is kept around, so
+        memory stays bounded by chunk_size + READ_BLOCK_SIZE and every
+        character is scanned a constant number of times.
+        """
+        chunk_size = chunk_size or config.CHUNK_SIZE
+        overlap = config.CHUNK_OVERLAP if overlap is None else overlap
+
+        buffer = ""
+        pending = 0  # start of text in buffer that no chunk has covered yet
+        for block in blocks:
+            buffer += block
+            start = 0
+            while len(buffer) - start >= chunk_size:
+                end = self._find_break(buffer, start, start + chunk_size)
+                chunk = buffer[start:end].strip()
+                if chunk:
+                    yield chunk
+                pending = end
+                start = self._overlap_start(buffer, start, end, overlap)
+            buffer = buffer[start:]
+            pending -= start
+
+        if buffer[max(pending, 0):].strip():
+            yield buffer.strip()
+
+    def _find_break(self, text, start, limit):
+        floor = start + (limit - start) // 2
+        for sep in BREAKS:
+            pos = text.rfind(sep, floor, limit)
+            if pos != -1:
+                return pos + len(sep)
+        return limit
+
+    def _overlap_start(self, text, start, end, overlap):
+        if overlap <= 0:
+            return end
+        pos = max(end - overlap, start + 1)
+        space = text.find(" ", pos, end)
+        return space + 1 if space != -1 else pos
+
+    def _staging_path(self, document_id, suffix="f32"):
+        return os.path.join(config.VECTOR_DIR, "staging", f"{document_id}.{suffix}")
+
+    def _track(self, blocks, total, progress):
+        done = 0
+        for block in blocks:
+            done += len(block)
+            if progress:
+                progress(min(done / total, 1.0))
+            yield block
+
+    def _store_chunks(self, db, document_id, chunks, staged, existing):
+        """Diff chunks against the document's existing rows by content hash.
+
+        Unchanged chunks keep their row and embedding and get their new
+        position in next_index; new ones are inserted without a chunk_index
+        and their vectors staged, CHUNK_INSERT_BATCH rows at a time. Repeated chunks are stored once,
+        so chunk_index numbers the distinct chunks densely and the count
+        returned (the document's chunk_count) is of distinct chunks. Rows
+        matched here are popped from `existing`, leaving the stale ones.
+        """
+        rows = []
+        kept = []
+        seen = set()
+        index = 0
+        for text in chunks:
+            content_hash = hashlib.sha1(text.encode()).hexdigest()
+            if content_hash in seen:
+                continue
+            seen.add(content_hash)
+            current = existing.pop(content_hash, None)
+            if current is not None:
+                kept.append({"id": current.id, "next_index": index})
             else:
-                return f"Document content from {os.path.basename(file_path)}"
-        except:
-            return "Sample document content"
-    
-    def process_document(self, user_id, file_path, original_filename):
+                rows.append({
+                    "document_id": document_id,
+                    "next_index": index,
+                    "chunk_text": text,
+                    "content_hash": content_hash,
+                    "embedding_id": f"{document_id}-{content_hash[:16]}"
+                })
+            index += 1
+            if len(rows) >= config.CHUNK_INSERT_BATCH:
+                self._flush_chunks(db, rows, staged)
+                rows = []
+            if len(kept) >= config.CHUNK_INSERT_BATCH:
+                db.execute(update(DocumentChunk), kept)
+                db.commit()
+                kept = []
+        if rows:
+            self._flush_chunks(db, rows, staged)
+        if kept:
+            db.execute(update(DocumentChunk), kept)
+            db.commit()
+        return len(seen)
+
+    def _flush_chunks(self, db, rows, staged):
+        # Commit per batch so a large document never holds the SQLite write
+        # lock for long; a failed ingest deletes its partial rows instead
+        vectors, ids = staged
+        db.execute(insert(DocumentChunk), rows)
+        db.commit()
+        vectors.write(embedder.embed([row["chunk_text"] for row in rows]).tobytes())
+        ids.write("".join(f"{row['embedding_id']}\n" for row in rows))
+
+    def create_document(self, user_id, file_path, original_filename, content_hash=None, owner=None):
         db = SessionLocal()
         try:
-            file_type = original_filename.split('.')[-1].lower()
-            
             document = Document(
                 user_id=user_id,
-                filename=original_filename,
+                filename=os.path.basename(file_path),
                 original_filename=original_filename,
-                file_type=file_type,
-                content=self.extract_text(file_path, file_type),
-                is_processed=True
+                file_type=original_filename.split('.')[-1].lower(),
+                file_size=os.path.getsize(file_path),
+                content_hash=content_hash,
+                status="queued",
+                owner=owner
             )
             db.add(document)
             db.commit()
             db.refresh(document)
             return document
-        except Exception as e:
+        finally:
+            db.close()
+
+    def existing_query(self, user_id, original_filename, content_hash):
+        """A live document with the same content, or else the latest with the same name"""
+        return select(Document).filter(
+            Document.user_id == user_id,
+            Document.status != "failed",
+            or_(Document.content_hash == content_hash, Document.original_filename == original_filename)
+        ).order_by(
+            (Document.content_hash == content_hash).desc(),
+            Document.uploaded_at.desc()
+        ).limit(1)
+
+    def find_existing(self, user_id, original_filename, content_hash):
+        db = SessionLocal()
+        try:
+            return db.scalars(self.existing_query(user_id, original_filename, content_hash)).first()
+        finally:
+            db.close()
+
+    def replace_file(self, document_id, file_path, content_hash=None, owner=None):
+        """Point a document at a newly uploaded version so it is re-ingested in place.
+
+        The version it replaces, file included, is kept until the new one
+        is processed, so a failed re-upload can fall back to it.
+        """
+        db = SessionLocal()
+        try:
+            document = db.get(Document, document_id)
+            if document.previous_version is None:
+                document.previous_version = json.dumps({
+                    "filename": document.filename,
+                    "file_size": document.file_size,
+                    "content_hash": document.content_hash,
+                    "chunk_count": document.chunk_count,
+                    "uploaded_at": document.uploaded_at.isoformat()
+                })
+            document.filename = os.path.basename(file_path)
+            document.file_size = os.path.getsize(file_path)
+            document.content_hash = content_hash
+            document.status = "queued"
+            document.error = None
+            document.owner = owner
+            document.uploaded_at = datetime.utcnow()
+            db.commit()
+            db.refresh(document)
+        finally:
+            db.close()
+        return document
+
+    def ingest(self, document_id, file_path, file_type, progress=None):
+        """Extract, chunk and embed a document and store its chunk rows.
+
+        This is the CPU-heavy half of processing and is safe to run in a
+        worker process. On a re-upload only new or changed chunks are
+        embedded; their vectors go to a staging file that index_document
+        loads into the in-process indexes afterwards. Rows of the version
+        being replaced stay until index_document finishes.
+        """
+        db = SessionLocal()
+        staging = self._staging_path(document_id)
+        staging_ids = self._staging_path(document_id, "ids")
+        try:
+            # Start over from an attempt that was cut short
+            db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).update(
+                {"next_index": None}, synchronize_session=False
+            )
+            # Rows from before chunks were hashed cannot be diffed, so they are left to go stale
+            existing = {
+                row.content_hash: row for row in db.execute(
+                    select(DocumentChunk.id, DocumentChunk.content_hash).filter(
+                        DocumentChunk.document_id == document_id,
+                        DocumentChunk.content_hash.is_not(None)
+                    )
+                )
+            }
+            db.query(Document).filter(Document.id == document_id).update({"status": "extracting"})
+            db.commit()
+
+            os.makedirs(os.path.dirname(staging), exist_ok=True)
+            total = max(os.path.getsize(file_path), 1)
+            with open(staging, "wb") as vectors, open(staging_ids, "w") as ids:
+                blocks = self._track(self.iter_text(file_path, file_type), total, progress)
+                count = self._store_chunks(db, document_id, self.chunk_text(blocks), (vectors, ids), existing)
+
+            db.query(Document).filter(Document.id == document_id).update({"status": "indexing"})
+            db.commit()
+            logger.info(f"Ingested document {document_id}: {count} chunks, {len(existing)} to remove")
+            return count
+        except Exception:
             db.rollback()
-            raise e
+            self._remove_staging(document_id)
+            raise
         finally:
             db.close()
-    
-    def search_documents(self, query, user_id, top_k=3):
-        return [{
-            'text': f"Information about: {query}",
-            'metadata': {'filename': 'sample.pdf'},
-            'score': 0.9
-        }]
-
-doc_processor = DocumentProcessor()
\ No newline at end of file
+
+    def _remove_staging(self, document_id):
+        for suffix in ("f32", "ids"):
+            path = self._staging_path(document_id, suffix)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _staged(self, document_id):
+        """Vectors staged by ingest, by embedding id"""
+        staging_ids = self._staging_path(document_id, "ids")
+        if not os.path.exists(staging_ids):
+            return {}, None
+        with open(staging_ids) as f:
+            positions = {line.rstrip("\n"): i for i, line in enumerate(f)}
+        if not positions:
+            return positions, None
+        vectors = np.memmap(self._staging_path(document_id), dtype=np.float32, mode="r")
+        return positions, vectors.reshape(-1, config.EMBEDDING_DIM)
+
+    def index_document(self, user_id, document_id, progress=None):
+        """Bring the vector and lexical indexes in line with a document's chunk rows.
+
+        Chunks of the version ingest stored (the rows with a next_index)
+        that are missing from the indexes are added, with the vectors ingest
+        staged (chunks it did not stage, e.g. after a restart, are embedded
+        here). Then, in one commit, the version becomes the document's and
+        the rows only the replaced version had are deleted; their index
+        entries and file go after that. chunk_text stays the durable copy of
+        each chunk, so the indexes can always be rebuilt from the database.
+        """
+        db = SessionLocal()
+        indexed = []
+        try:
+            document = db.get(Document, document_id)
+            prefix = f"{document_id}-"
+            present = set(vector_index.ids(user_id, prefix)) | set(lexical_index.ids(user_id, prefix))
+            current = db.scalars(
+                select(DocumentChunk.embedding_id).filter(
+                    DocumentChunk.document_id == document_id,
+                    DocumentChunk.next_index.is_not(None)
+                )
+            ).all()
+            missing = [embedding_id for embedding_id in current if embedding_id not in present]
+
+            positions, vectors = self._staged(document_id)
+            for start in range(0, len(missing), config.CHUNK_INSERT_BATCH):
+                batch = db.execute(
+                    select(DocumentChunk.embedding_id, DocumentChunk.chunk_text).filter(
+                        DocumentChunk.embedding_id.in_(missing[start:start + config.CHUNK_INSERT_BATCH])
+                    )
+                ).all()
+                lost = [row.embedding_id for row in batch if row.chunk_text is None]
+                if lost:
+                    logger.warning(f"Document {document_id}: {len(lost)} chunks have no text left to index")
+                    batch = [row for row in batch if row.chunk_text is not None]
+                if not batch:
+                    continue
+                ids = [row.embedding_id for row in batch]
+                texts = [row.chunk_text for row in batch]
+                unstaged = [i for i, embedding_id in enumerate(ids) if embedding_id not in positions]
+                if unstaged:
+                    batch_vectors = np.empty((len(ids), config.EMBEDDING_DIM), dtype=np.float32)
+                    for i, embedding_id in enumerate(ids):
+                        if embedding_id in positions:
+                            batch_vectors[i] = vectors[positions[embedding_id]]
+                    batch_vectors[unstaged] = embedder.embed([texts[i] for i in unstaged])
+                else:
+                    batch_vectors = vectors[[positions[embedding_id] for embedding_id in ids]]
+                indexed.extend(ids)
+                vector_index.add(user_id, ids, batch_vectors, texts)
+                lexical_index.add(user_id, ids, texts)
+                if progress:
+                    progress(len(indexed) / len(missing))
+            del vectors
+            self._restore_texts(db, user_id, document_id)
+
+            db.query(DocumentChunk).filter(
+                DocumentChunk.document_id == document_id,
+                DocumentChunk.next_index.is_(None)
+            ).delete(synchronize_session=False)
+            db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).update(
+                {"chunk_index": DocumentChunk.next_index, "next_index": None}, synchronize_session=False
+            )
+            previous = json.loads(document.previous_version) if document.previous_version else None
+            document.chunk_count = len(current)
+            document.previous_version = None
+            document.is_processed = True
+            document.status = "processed"
+            db.commit()
+            db.refresh(document)
+
+            current = set(current)
+            stale = [embedding_id for embedding_id in present if embedding_id not in current]
+            vector_index.remove(user_id, stale)
+            lexical_index.remove(user_id, stale)
+            if previous and previous["filename"] != document.filename:
+                self._remove_upload(previous["filename"])
+            vector_index.save(user_id)
+            lexical_index.save(user_id)
+            response_cache.invalidate_user(user_id)
+            self._remove_staging(document_id)
+            logger.info(
+                f"Processed {document.original_filename}: {document.chunk_count} chunks, "
+                f"{len(indexed)} indexed, {len(stale)} removed"
+            )
+            return document
+        except Exception:
+            db.rollback()
+            vector_index.remove(user_id, indexed)
+            lexical_index.remove(user_id, indexed)
+            raise
+        finally:
+            db.close()
+
+    def _restore_texts(self, db, user_id, document_id):
+        """Copy chunk texts back from the vector store for rows an earlier version cleared"""
+        cleared = db.scalars(
+            select(DocumentChunk.embedding_id).filter(
+                DocumentChunk.document_id == document_id,
+                DocumentChunk.chunk_text.is_(None)
+            )
+        ).all()
+        for start in range(0, len(cleared), config.CHUNK_INSERT_BATCH):
+            texts = vector_index.texts(user_id, cleared[start:start + config.CHUNK_INSERT_BATCH])
+            if texts:
+                chunks = DocumentChunk.__table__
+                db.execute(
+                    update(chunks).where(chunks.c.embedding_id == bindparam("key")).values(chunk_text=bindparam("text")),
+                    [{"key": embedding_id, "text": text} for embedding_id, text in texts.items()]
+                )
+
+    def mark_failed(self, document_id, error):
+        """Give up on the version being processed.
+
+        A failed re-upload falls back to the version it replaced: only the
+        rows and index entries the new version added are dropped, and the
+        document keeps its earlier file, with `error` saying what went
+        wrong. A document with no earlier version is marked failed.
+        """
+        db = SessionLocal()
+        try:
+            document = db.get(Document, document_id)
+            user_id = document.user_id
+            failed_file = document.filename
+            previous = json.loads(document.previous_version) if document.previous_version else None
+            if previous is None:
+                added = vector_index.ids(user_id, f"{document_id}-")
+                db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).delete()
+                db.query(Document).filter(Document.id == document_id).update({
+                    "status": "failed",
+                    "error": error,
+                    "chunk_count": 0,
+                    "is_processed": False
+                })
+            else:
+                added = db.scalars(
+                    select(DocumentChunk.embedding_id).filter(
+                        DocumentChunk.document_id == document_id,
+                        DocumentChunk.chunk_index.is_(None)
+                    )
+                ).all()
+                db.query(DocumentChunk).filter(
+                    DocumentChunk.document_id == document_id,
+                    DocumentChunk.chunk_index.is_(None)
+                ).delete(synchronize_session=False)
+                db.query(DocumentChunk).filter(DocumentChunk.document_id == document_id).update(
+                    {"next_index": None}, synchronize_session=False
+                )
+                db.query(Document).filter(Document.id == document_id).update({
+                    "filename": previous["filename"],
+                    "file_size": previous["file_size"],
+                    "content_hash": previous["content_hash"],
+                    "chunk_count": previous["chunk_count"],
+                    "uploaded_at": datetime.fromisoformat(previous["uploaded_at"]),
+                    "previous_version": None,
+                    "status": "processed",
+                    "error": error,
+                    "is_processed": True
+                })
+            db.commit()
+        finally:
+            db.close()
+        vector_index.remove(user_id, added)
+        lexical_index.remove(user_id, added)
+        if added:
+            vector_index.save(user_id)
+            lexical_index.save(user_id)
+        if previous and previous["filename"] != failed_file:
+            self._remove_upload(failed_file)
+        self._remove_staging(document_id)
+
+    def _remove_upload(self, filename):
+        path = os.path.join(config.UPLOAD_DIR, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def process_document(self, user_id, file_path, original_filename):
+        """Run the whole pipeline inline and return the processed Document.
+
+        Uploading a file again returns the existing document; uploading a
+        new version of a file with the same name re-indexes it in place.
+        """
+        content_hash = file_hash(file_path)
+        document = self.find_existing(user_id, original_filename, content_hash)
+        if document is not None and document.content_hash == content_hash:
+            os.remove(file_path)
+            return document
+        if document is not None:
+            document = self.replace_file(document.id, file_path, content_hash)
+        else:
+            document = self.create_document(user_id, file_path, original_filename, content_hash)
+        try:
+            with metrics.span("ingest.extract"):
+                self.ingest(document.id, file_path, document.file_type)
+            with metrics.span("ingest.index"):
+                return self.index_document(user_id, document.id)
+        except Exception as e:
+            self.mark_failed(document.id, str(e))
+            raise
+
+    async def search(self, query, user_id, top_k=3, mode=None):
+        """search_documents for request handlers: concurrent queries are embedded in batches"""
+        mode = mode or config.SEARCH_MODE
+        query_vector = None
+        if mode != "lexical":
+            with metrics.span("retrieval.embed"):
+                query_vector = await query_batcher.submit(query)
+        with metrics.span("retrieval.search"):
+            return await run_in_threadpool(self.search_documents, query, user_id, top_k, mode, query_vector)
+
+    def search_documents(self, query, user_id, top_k=3, mode=None, query_vector=None):
+        """Dense, lexical (BM25) or hybrid retrieval; hybrid fuses both rankings with RRF.
+
+        With a reranker configured, RERANK_CANDIDATES chunks are fetched
+        and the reranker picks the top_k among them.
+        """
+        mode = mode or config.SEARCH_MODE
+        candidates = max(top_k, config.RERANK_CANDIDATES) if reranker else top_k
+        if mode != "lexical":
+            queries = embedder.embed([query]) if query_vector is None else query_vector[None, :]
+        if mode == "dense":
+            hits = vector_index.search(user_id, queries, candidates)[0]
+        elif mode == "lexical":
+            hits = lexical_index.search(user_id, query, candidates)
+        else:
+            depth = max(candidates * 4, 20) if not reranker else candidates
+            dense = vector_index.search(user_id, queries, depth)[0]
+            lexical = lexical_index.search(user_id, query, depth)
+            hits = reciprocal_rank_fusion([dense, lexical])[:candidates]
+        results = self._load_hits(hits, user_id)
+        if reranker:
+            with metrics.span("retrieval.rerank"):
+                return reranker.rerank(query, results, top_k)
+        return results
+
+    def _load_hits(self, hits, user_id):
+        """Turn (embedding_id, score) pairs into result dicts, keeping their order"""
+        if not hits:
+            return []
+        texts = vector_index.texts(user_id, [embedding_id for embedding_id, _ in hits])
+        db = SessionLocal()
+        try:
+            rows = db.query(
+                DocumentChunk.embedding_id,
+                DocumentChunk.chunk_text,
+                # A chunk of a version still being processed has only its next position
+                func.coalesce(DocumentChunk.chunk_index, DocumentChunk.next_index).label("chunk_index"),
+                Document.id,
+                Document.original_filename
+            ).join(Document).filter(
+                DocumentChunk.embedding_id.in_([embedding_id for embedding_id, _ in hits])
+            ).all()
+        finally:
+            db.close()
+
+        chunks = {row[0]: row for row in rows}
+        results = []
+        for embedding_id, score in hits:
+            row = chunks.get(embedding_id)
+            if row is None:
+                continue
+            results.append({
+                'text': texts.get(embedding_id) or row.chunk_text,
+                'metadata': {
+                    'filename': row.original_filename,
+                    'document_id': row.id,
+                    'chunk_index': row.chunk_index,
+                    'chunk_id': embedding_id
+                },
+                'score': score
+            })
+        return results
+
+doc_processor = DocumentProcessor()
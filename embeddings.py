@@ -0,0 +1,140 @@
+import hashlib
+import math
+import re
+import threading
+import zlib
+from collections import Counter, OrderedDict
+import numpy as np
+
+from app.config import config, logger
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+class EmbeddingProvider:
+    """Turns a batch of texts into a (len(texts), dim) float32 matrix of unit vectors"""
+
+    name = "base"
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def embed(self, texts):
+        raise NotImplementedError
+
+class HashingEmbedder(EmbeddingProvider):
+    """Deterministic CPU embeddings: signed feature hashing of word unigrams and
+    bigrams with sublinear term frequency, so it needs no model or network"""
+
+    name = "hashing"
+
+    def __init__(self, dim):
+        super().__init__(dim)
+        self.buckets = {}
+
+    def _bucket(self, feature):
+        bucket = self.buckets.get(feature)
+        if bucket is None:
+            h = zlib.crc32(feature.encode())
+            bucket = (h % self.dim, 1.0 if h & 0x80000000 else -1.0)
+            if len(self.buckets) < 500_000:
+                self.buckets[feature] = bucket
+        return bucket
+
+    def embed(self, texts):
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            words = TOKEN_RE.findall(text.lower())
+            features = Counter(words)
+            features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+            for feature, tf in features.items():
+                col, sign = self._bucket(feature)
+                rows.append(row)
+                cols.append(col)
+                values.append(sign * (1.0 + math.log(tf)))
+
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(matrix, (rows, cols), values)
+        return normalize_rows(matrix)
+
+class OpenAIEmbedder(EmbeddingProvider):
+    name = "openai"
+
+    def __init__(self, dim, api_key, model):
+        super().__init__(dim)
+        import httpx
+
+        self.model = model
+        self.client = httpx.Client(
+            base_url="https://api.openai.com/v1",
+            headers={"Authorization": f"Bearer {api_key}"},
+            timeout=30.0
+        )
+
+    def embed(self, texts):
+        response = self.client.post("/embeddings", json={
+            "model": self.model,
+            "input": list(texts),
+            "dimensions": self.dim
+        })
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        matrix = np.array([item["embedding"] for item in data], dtype=np.float32)
+        return normalize_rows(matrix)
+
+class CachedEmbedder:
+    """Batches calls to a provider and caches vectors by a hash of the text"""
+
+    def __init__(self, provider, max_entries):
+        self.provider = provider
+        self.dim = provider.dim
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return hashlib.sha1(text.encode("utf-8", "replace")).digest()
+
+    def embed(self, texts):
+        keys = [self._key(text) for text in texts]
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+
+        missing = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                vector = self.cache.get(key)
+                if vector is not None:
+                    self.cache.move_to_end(key)
+                    result[i] = vector
+                    self.hits += 1
+                elif key in missing:
+                    missing[key].append(i)
+                else:
+                    missing[key] = [i]
+            self.misses += len(missing)
+
+        pending = list(missing.items())
+        for start in range(0, len(pending), config.EMBED_BATCH_SIZE):
+            batch = pending[start:start + config.EMBED_BATCH_SIZE]
+            vectors = self.provider.embed([texts[positions[0]] for _, positions in batch])
+            with self.lock:
+                for (key, positions), vector in zip(batch, vectors):
+                    result[positions] = vector
+                    self.cache[key] = vector.copy()
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+        return result
+
+def get_provider():
+    if config.EMBEDDING_BACKEND == "openai":
+        if config.OPENAI_KEY:
+            return OpenAIEmbedder(config.EMBEDDING_DIM, config.OPENAI_KEY, config.EMBEDDING_MODEL)
+        logger.warning("EMBEDDING_BACKEND is openai but no OPENAI_API_KEY is set, using hashing embedder")
+    return HashingEmbedder(config.EMBEDDING_DIM)
+
+embedder = CachedEmbedder(get_provider(), config.EMBED_CACHE_SIZE)
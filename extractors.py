@@ -0,0 +1,141 @@
+import multiprocessing
+import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from app.config import config, logger
+from app.structured_logging import init_pool_worker
+
+class ExtractionError(Exception):
+    pass
+
+def iter_txt(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            while True:
+                block = f.read(config.READ_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+    except UnicodeDecodeError as e:
+        raise ExtractionError(f"File is not valid UTF-8 text: {e}")
+
+MD_FENCE_RE = re.compile(r"^\s*(```|~~~)")
+MD_PREFIX_RE = re.compile(r"^\s{0,3}(#{1,6}\s+|>\s?|[-*+]\s+|\d+[.)]\s+)")
+MD_IMAGE_RE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+MD_LINK_RE = re.compile(r"\[([^\]]+)\]\([^)]*\)")
+MD_EMPHASIS_RE = re.compile(r"(?<!\w)(\*{1,3}|_{1,3}|~~)(?=\S)|(?<=\S)(\*{1,3}|_{1,3}|~~)(?!\w)|`")
+MD_HTML_RE = re.compile(r"</?[A-Za-z][^>\n]*>")
+
+def strip_markdown(line):
+    line = MD_PREFIX_RE.sub("", line)
+    line = MD_IMAGE_RE.sub(r"\1", line)
+    line = MD_LINK_RE.sub(r"\1", line)
+    line = MD_HTML_RE.sub("", line)
+    return MD_EMPHASIS_RE.sub("", line)
+
+def iter_markdown(file_path):
+    """Markdown as plain text: syntax is stripped line by line, code blocks are kept verbatim"""
+    in_code = False
+    block = []
+    size = 0
+    for line in iter_lines(file_path):
+        if MD_FENCE_RE.match(line):
+            in_code = not in_code
+            continue
+        text = line if in_code else strip_markdown(line)
+        block.append(text)
+        size += len(text)
+        if size >= config.READ_BLOCK_SIZE:
+            yield "".join(block)
+            block = []
+            size = 0
+    if block:
+        yield "".join(block)
+
+def iter_lines(file_path):
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield from f
+    except UnicodeDecodeError as e:
+        raise ExtractionError(f"File is not valid UTF-8 text: {e}")
+
+def open_pdf(file_path):
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ExtractionError("PDF support needs the pypdf package")
+    try:
+        reader = PdfReader(file_path)
+        if reader.is_encrypted:
+            raise ExtractionError("PDF is encrypted")
+        return reader
+    except ExtractionError:
+        raise
+    except Exception as e:
+        raise ExtractionError(f"Could not read PDF: {e}")
+
+def extract_pdf_range(file_path, start, end):
+    """Text of pages [start, end); runs in PDF worker processes"""
+    reader = open_pdf(file_path)
+    return [page_text(reader, number) for number in range(start, end)]
+
+def page_text(reader, number):
+    try:
+        return (reader.pages[number].extract_text() or "") + "\n\n"
+    except Exception as e:
+        raise ExtractionError(f"Could not extract page {number + 1}: {e}")
+
+pdf_pool = None
+pdf_pool_lock = threading.Lock()
+
+def get_pdf_pool():
+    global pdf_pool
+    with pdf_pool_lock:
+        if pdf_pool is None:
+            pdf_pool = ProcessPoolExecutor(
+                max_workers=config.PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_pool_worker
+            )
+        return pdf_pool
+
+def iter_pdf_pages(file_path):
+    """Yield PDF text one page at a time.
+
+    Large PDFs are split into PDF_PAGES_PER_TASK page ranges that are
+    extracted in a process pool. Pages are still yielded in order, with at
+    most two ranges per worker in flight to keep memory bounded.
+    """
+    reader = open_pdf(file_path)
+    page_count = len(reader.pages)
+
+    if page_count < config.PDF_PARALLEL_PAGES or config.PDF_WORKERS < 2:
+        for number in range(page_count):
+            yield page_text(reader, number)
+        return
+
+    logger.info(f"Extracting {page_count} PDF pages in parallel")
+    pool = get_pdf_pool()
+    ranges = deque(
+        (start, min(start + config.PDF_PAGES_PER_TASK, page_count))
+        for start in range(0, page_count, config.PDF_PAGES_PER_TASK)
+    )
+    in_flight = deque()
+    while ranges or in_flight:
+        while ranges and len(in_flight) < config.PDF_WORKERS * 2:
+            in_flight.append(pool.submit(extract_pdf_range, file_path, *ranges.popleft()))
+        try:
+            pages = in_flight.popleft().result()
+        except ExtractionError:
+            raise
+        except Exception as e:
+            raise ExtractionError(f"PDF extraction worker failed: {e}")
+        yield from pages
+
+EXTRACTORS = {
+    "txt": iter_txt,
+    "md": iter_markdown,
+    "pdf": iter_pdf_pages
+}
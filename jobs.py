@@ -0,0 +1,301 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import update
+
+from app.config import config, logger
+from app.database import Document, SessionLocal
+from app.document_processor import doc_processor
+from app.metrics import metrics
+from app.structured_logging import forward_to, init_pool_worker, listen
+
+try:
+    import fcntl
+except ImportError:
+    # No way to tell whether another process is alive; run a single server process there
+    fcntl = None
+
+IN_FLIGHT = ("queued", "extracting", "indexing")
+
+progress_queue = None
+
+def init_worker(queue, log_queue):
+    global progress_queue
+    progress_queue = queue
+    forward_to(log_queue, config.LOG_DEBUG_SAMPLE)
+    # Ingestion yields the CPU to the web process serving chat
+    if hasattr(os, "nice"):
+        os.nice(config.INGEST_NICE)
+
+def run_ingest(document_id, file_path, file_type):
+    def progress(fraction):
+        progress_queue.put((document_id, fraction))
+    return doc_processor.ingest(document_id, file_path, file_type, progress)
+
+class QueueFull(Exception):
+    pass
+
+class UserQueueFull(QueueFull):
+    pass
+
+class IngestionQueue:
+    """Runs document ingestion off the request path.
+
+    Extraction, chunking and embedding happen in a process pool. The
+    vector and lexical indexes live in this process, so the final index
+    step runs on a single local thread.
+    """
+
+    def __init__(self, workers, max_pending, max_per_user):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.jobs = {}
+        # Slots held by uploads whose file is still being saved, per user
+        self.reserved = {}
+        self.lock = threading.Lock()
+        self.pool_lock = threading.Lock()
+        self.context = None
+        self.pool = None
+        self.indexer = None
+        self.progress = None
+        self.log_queue = None
+        self.log_listener = None
+        self.owner = None
+        self.owner_file = None
+
+    def start(self):
+        # Documents record the queue that owns them; the flock on RUN_DIR/<owner>
+        # shows other server processes that this one is still running
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        if fcntl is not None:
+            os.makedirs(config.RUN_DIR, exist_ok=True)
+            self.owner_file = open(os.path.join(config.RUN_DIR, self.owner), "w")
+            fcntl.flock(self.owner_file, fcntl.LOCK_EX)
+        self.context = multiprocessing.get_context("spawn")
+        self.progress = self.context.Queue()
+        # Workers hand their log records to this process, which owns the log file
+        self.log_queue = self.context.Queue(config.LOG_QUEUE_SIZE)
+        self.log_listener = listen(self.log_queue)
+        self.pool = self._new_pool()
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indexer")
+        threading.Thread(target=self._drain_progress, name="ingest-progress", daemon=True).start()
+        logger.info(f"Ingestion queue started with {self.workers} workers")
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self.context,
+            initializer=init_pool_worker,
+            initargs=("app.jobs:init_worker", self.progress, self.log_queue)
+        )
+
+    def _submit_ingest(self, *args):
+        """Submit to the worker pool, replacing it first if a worker died and broke it"""
+        pool = self.pool
+        try:
+            return pool.submit(run_ingest, *args)
+        except BrokenProcessPool:
+            with self.pool_lock:
+                if self.pool is pool:
+                    logger.error("Ingestion worker pool is broken, starting a new one")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = self._new_pool()
+            return self.pool.submit(run_ingest, *args)
+
+    def shutdown(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.indexer.shutdown(wait=True)
+            self.progress.put(None)
+            self.log_listener.stop()
+        if self.owner_file:
+            self.owner_file.close()
+            os.remove(self.owner_file.name)
+            self.owner_file = None
+
+    def pending(self, user_id=None):
+        with self.lock:
+            return self._pending(user_id)
+
+    def _pending(self, user_id=None):
+        if user_id is None:
+            return len(self.jobs) + sum(self.reserved.values())
+        return self.reserved.get(user_id, 0) + sum(1 for job in self.jobs.values() if job["user_id"] == user_id)
+
+    def reserve(self, user_id):
+        """Hold a slot for an upload before its file is saved, so concurrent uploads
+        cannot all pass the limits; submit(reserved=True) or release() gives it back"""
+        with self.lock:
+            if self._pending() >= self.max_pending:
+                raise QueueFull("Too many documents processing, try again later")
+            if self._pending(user_id) >= self.max_per_user:
+                raise UserQueueFull("Too many of your documents are processing, try again later")
+            self.reserved[user_id] = self.reserved.get(user_id, 0) + 1
+
+    def release(self, user_id):
+        with self.lock:
+            self._release(user_id)
+
+    def _release(self, user_id):
+        self.reserved[user_id] -= 1
+        if not self.reserved[user_id]:
+            del self.reserved[user_id]
+
+    def submit(self, document, reserved=False):
+        job = {
+            "document_id": document.id,
+            "user_id": document.user_id,
+            "status": "queued",
+            "progress": 0.0,
+            "chunks": 0,
+            "error": None,
+            "submitted": time.perf_counter()
+        }
+        with self.lock:
+            if reserved:
+                self._release(document.user_id)
+            elif self._pending() >= self.max_pending:
+                raise QueueFull("Too many documents waiting to be processed")
+            self.jobs[document.id] = job
+
+        file_path = os.path.join(config.UPLOAD_DIR, document.filename)
+        try:
+            future = self._submit_ingest(document.id, file_path, document.file_type)
+        except Exception:
+            # The caller marks the document failed; keep it from holding a slot
+            self._finish(job)
+            raise
+        future.add_done_callback(lambda f: self._ingested(job, f))
+        return dict(job)
+
+    def status(self, document_id):
+        job = self.jobs.get(document_id)
+        return dict(job) if job else None
+
+    def resume(self):
+        """Requeue documents whose processing was cut short by a restart.
+
+        With several server processes each one runs this at startup, so a
+        document is claimed first and only the process that claims it
+        requeues it; documents owned by a live process are left alone.
+        """
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            documents = db.query(Document).filter(Document.status.in_(IN_FLIGHT)).all()
+            for document in documents:
+                if self._owner_alive(document.owner) or not self._claim(db, document, document.owner, self.owner):
+                    continue
+                try:
+                    self.submit(document)
+                except QueueFull:
+                    # Let a process with room take it
+                    self._claim(db, document, self.owner, None)
+                    break
+                except Exception as e:
+                    logger.error(f"Could not requeue document {document.id}: {e}")
+                    doc_processor.mark_failed(document.id, str(e))
+        finally:
+            db.close()
+
+    def _claim(self, db, document, owner, new_owner):
+        """Move a document from `owner` to `new_owner`; false if another process got there first"""
+        result = db.execute(
+            update(Document).where(
+                Document.id == document.id,
+                Document.status.in_(IN_FLIGHT),
+                Document.owner.is_not_distinct_from(owner)
+            ).values(owner=new_owner)
+        )
+        db.commit()
+        return result.rowcount == 1
+
+    def _owner_alive(self, owner):
+        if owner is None or fcntl is None:
+            return False
+        if owner == self.owner:
+            return True
+        if owner.split(":")[0] != socket.gethostname():
+            # Its uploads are on that host, so its documents are left to it
+            return True
+        path = os.path.join(config.RUN_DIR, owner)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return False
+
+    def _ingested(self, job, future):
+        if future.cancelled():
+            # Cut off by shutdown before it started; the document stays "queued" and is resumed on the next start
+            self._finish(job)
+            return
+        try:
+            job["chunks"] = future.result()
+        except Exception as e:
+            self._fail(job, e)
+            return
+        # Queue wait plus extraction, chunking and embedding in a worker
+        metrics.stage("ingest.extract", time.perf_counter() - job["submitted"])
+        job.update(status="indexing", progress=0.0)
+        try:
+            self.indexer.submit(self._index, job)
+        except RuntimeError:
+            # Shutting down; the document stays "indexing" and is resumed on the next start
+            self._finish(job)
+
+    def _index(self, job):
+        try:
+            with metrics.span("ingest.index"):
+                doc_processor.index_document(
+                    job["user_id"],
+                    job["document_id"],
+                    progress=lambda fraction: job.update(progress=fraction)
+                )
+            job.update(status="processed", progress=1.0)
+        except Exception as e:
+            self._fail(job, e)
+            return
+        metrics.inc("ingest_jobs_total", result="processed")
+        self._finish(job)
+
+    def _fail(self, job, error):
+        logger.error(f"Ingestion of document {job['document_id']} failed: {error}")
+        job.update(status="failed", error=str(error))
+        metrics.inc("ingest_jobs_total", result="failed")
+        try:
+            doc_processor.mark_failed(job["document_id"], str(error))
+        finally:
+            self._finish(job)
+
+    def _finish(self, job):
+        # Finished jobs are answered from the Document row from here on
+        with self.lock:
+            self.jobs.pop(job["document_id"], None)
+
+    def _drain_progress(self):
+        while True:
+            item = self.progress.get()
+            if item is None:
+                return
+            document_id, fraction = item
+            job = self.jobs.get(document_id)
+            if job and job["status"] in ("queued", "extracting"):
+                job.update(status="extracting", progress=fraction)
+
+ingestion_queue = IngestionQueue(config.INGEST_WORKERS, config.INGEST_MAX_PENDING, config.INGEST_MAX_PER_USER)
@@ -0,0 +1,445 @@
+import math
+import os
+import pickle
+import re
+import tempfile
+import threading
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+
+from app.config import config, logger
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking without fcntl; run a single writer process there
+    fcntl = None
+
+# Keeps part numbers and error codes such as "XR-7" or "E-4411" together
+TERM_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+PART_RE = re.compile(r"[a-z0-9]+")
+
+def tokenize(text):
+    terms = []
+    for term in TERM_RE.findall(text.lower()):
+        terms.append(term)
+        if not term.isalnum():
+            terms.extend(PART_RE.findall(term))
+    return terms
+
+# Common words that match most chunks and barely move a BM25 score
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have how i if in into is it its of on or
+that the their then there these this to was were what when where which who why will with
+""".split())
+
+class LexicalPartition:
+    """BM25 inverted index for one user.
+
+    Each term owns two parallel uint32 arrays (row numbers and term
+    frequencies), appended to as chunks arrive. Removed rows are tombstoned
+    and compacted out of the postings once they make up
+    LEXICAL_COMPACT_RATIO of the rows.
+
+    Adds and removes since the last save are kept in `pending`, so they
+    can be replayed onto a newer copy another process saved meanwhile.
+    """
+
+    STATE = ("terms", "postings", "ids", "rows", "lengths", "alive", "live_count", "total_length")
+
+    def __init__(self):
+        self.terms = {}
+        self.postings = []
+        self.ids = []
+        self.rows = {}
+        self.lengths = array("I")
+        self.alive = bytearray()
+        self.live_count = 0
+        self.total_length = 0
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.impacts = {}
+        self.pending = []
+        # Stat of the saved file this partition was read from or written to
+        self.version = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.live_count
+
+    def __setstate__(self, state):
+        # Partitions pickled whole, before save() wrote snapshots
+        self.__dict__.update(state)
+        self.scores = np.zeros(0, dtype=np.float32)
+        self.impacts = {}
+        self.pending = []
+        self.version = None
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        """A flat copy of the index for save() to write, and how many pending
+        changes it includes.
+
+        Postings only grow between compactions, and a compaction builds new
+        arrays, so the lock is held just long enough to note their lengths;
+        the copying happens after it is released.
+        """
+        with self.lock:
+            done = len(self.pending)
+            terms = self.terms.copy()
+            postings = self.postings
+            sizes = [len(rows) for rows, _ in postings]
+            state = {
+                "ids": self.ids.copy(),
+                "lengths": self.lengths.tobytes(),
+                "alive": bytes(self.alive),
+                "live_count": self.live_count,
+                "total_length": self.total_length
+            }
+        names = [None] * len(postings)
+        for term, term_id in terms.items():
+            names[term_id] = term
+        state.update({
+            "terms": names,
+            "sizes": array("I", sizes).tobytes(),
+            "rows": b"".join(rows[:size].tobytes() for (rows, _), size in zip(postings, sizes)),
+            "tfs": b"".join(tfs[:size].tobytes() for (_, tfs), size in zip(postings, sizes))
+        })
+        return state, done
+
+    def saved(self, version, done):
+        with self.lock:
+            del self.pending[:done]
+            self.version = version
+
+    def take_over(self, fresh):
+        """Switch to a newer saved copy, replaying the changes not saved yet onto it"""
+        with self.lock:
+            for change in self.pending:
+                fresh._apply(*change)
+            fresh._maybe_compact()
+            for name in self.STATE:
+                setattr(self, name, getattr(fresh, name))
+            self.version = fresh.version
+            self.impacts.clear()
+
+    @classmethod
+    def from_snapshot(cls, state):
+        partition = cls()
+        partition.ids = state["ids"]
+        partition.lengths = array("I", state["lengths"])
+        partition.alive = bytearray(state["alive"])
+        partition.live_count = state["live_count"]
+        partition.total_length = state["total_length"]
+        partition.terms = {term: term_id for term_id, term in enumerate(state["terms"])}
+        rows, tfs = state["rows"], state["tfs"]
+        end = 0
+        for size in array("I", state["sizes"]):
+            start, end = end, end + 4 * size
+            partition.postings.append((array("I", rows[start:end]), array("I", tfs[start:end])))
+        partition.rows = {
+            embedding_id: row for row, embedding_id in enumerate(partition.ids) if partition.alive[row]
+        }
+        return partition
+
+    def add(self, ids, texts):
+        self.change("add", list(ids), list(texts))
+
+    def remove(self, ids):
+        self.change("remove", list(ids))
+
+    def change(self, *change):
+        with self.lock:
+            self._apply(*change)
+            self.pending.append(change)
+            self.impacts.clear()
+            self._maybe_compact()
+
+    def _apply(self, kind, ids, texts=None):
+        if kind == "remove":
+            for embedding_id in ids:
+                self._remove(embedding_id)
+            return
+        for embedding_id, text in zip(ids, texts):
+            if embedding_id in self.rows:
+                self._remove(embedding_id)
+            row = len(self.ids)
+            self.ids.append(embedding_id)
+            self.rows[embedding_id] = row
+
+            counts = Counter(tokenize(text))
+            length = sum(counts.values())
+            self.lengths.append(length)
+            self.alive.append(1)
+            self.live_count += 1
+            self.total_length += length
+
+            for term, tf in counts.items():
+                term_id = self.terms.get(term)
+                if term_id is None:
+                    term_id = self.terms[term] = len(self.postings)
+                    self.postings.append((array("I"), array("I")))
+                rows, tfs = self.postings[term_id]
+                rows.append(row)
+                tfs.append(tf)
+
+    def _remove(self, embedding_id):
+        row = self.rows.pop(embedding_id, None)
+        if row is None:
+            return
+        self.alive[row] = 0
+        self.live_count -= 1
+        self.total_length -= self.lengths[row]
+
+    def _maybe_compact(self):
+        if len(self.ids) - self.live_count > config.LEXICAL_COMPACT_RATIO * len(self.ids):
+            self._compact()
+
+    def _compact(self):
+        """Drop tombstoned rows from the postings and renumber the live ones"""
+        alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+        renumber = np.cumsum(alive, dtype=np.uint32) - 1
+        terms = {}
+        postings = []
+        for term, term_id in self.terms.items():
+            rows, tfs = self.postings[term_id]
+            rows = np.frombuffer(rows, dtype=np.uint32)
+            keep = alive[rows]
+            if not keep.any():
+                continue
+            terms[term] = len(postings)
+            postings.append((
+                array("I", renumber[rows[keep]].tobytes()),
+                array("I", np.frombuffer(tfs, dtype=np.uint32)[keep].tobytes())
+            ))
+        self.terms = terms
+        self.postings = postings
+        self.ids = [embedding_id for embedding_id, live in zip(self.ids, alive) if live]
+        self.rows = {embedding_id: row for row, embedding_id in enumerate(self.ids)}
+        self.lengths = array("I", np.frombuffer(self.lengths, dtype=np.uint32)[alive].tobytes())
+        self.alive = bytearray(b"\x01" * len(self.ids))
+
+    def _query_terms(self, query):
+        """Term ids to score, and whether they are selective.
+
+        Stopwords, unless the query has nothing else, and terms in more than
+        LEXICAL_MAX_DF of the live rows hardly change a ranking but dominate
+        its cost, so they are left out. When nothing else in the query
+        matches, only its rarest term is used. Partitions smaller than
+        LEXICAL_PRUNE_MIN_ROWS are cheap to score and skip the df cut.
+        """
+        matched = [(term, self.terms[term]) for term in set(tokenize(query)) if term in self.terms]
+        if not matched:
+            return [], True
+        matched = [(term, term_id) for term, term_id in matched if term not in STOPWORDS] or matched
+        if self.live_count < config.LEXICAL_PRUNE_MIN_ROWS:
+            return [term_id for _, term_id in matched], True
+        limit = config.LEXICAL_MAX_DF * self.live_count
+        selective = [term_id for _, term_id in matched if len(self.postings[term_id][0]) <= limit]
+        if selective:
+            return selective, True
+        return [min((term_id for _, term_id in matched), key=lambda t: len(self.postings[t][0]))], False
+
+    def _score_term(self, term_id, alive, lengths, avg_length, k1, b):
+        """Live rows holding a term and their BM25 weight for it"""
+        rows, tfs = self.postings[term_id]
+        rows = np.frombuffer(rows, dtype=np.uint32)
+        live = alive[rows]
+        rows = rows[live]
+        tfs = np.frombuffer(tfs, dtype=np.uint32)[live].astype(np.float32)
+        idf = math.log(1 + (self.live_count - len(rows) + 0.5) / (len(rows) + 0.5))
+        norm = k1 * (1 - b + b * lengths[rows] / avg_length)
+        return rows, idf * tfs * (k1 + 1) / (tfs + norm)
+
+    def search(self, query, top_k, k1=1.5, b=0.75):
+        """Scores accumulate in a dense per-row buffer that is reused across
+        searches; only the rows a query touched are read back and reset"""
+        with self.lock:
+            if not self.live_count:
+                return []
+            avg_length = self.total_length / self.live_count
+            lengths = np.frombuffer(self.lengths, dtype=np.uint32)
+            alive = np.frombuffer(self.alive, dtype=np.uint8).astype(bool)
+            term_ids, selective = self._query_terms(query)
+            if not term_ids:
+                return []
+
+            if not selective and top_k <= config.LEXICAL_IMPACT_DEPTH:
+                # A common term scores most rows, so its best rows are kept until the next write
+                cached = self.impacts.get(term_ids[0])
+                if cached is None:
+                    rows, hit_scores = self._score_term(term_ids[0], alive, lengths, avg_length, k1, b)
+                    top = self._top(hit_scores, config.LEXICAL_IMPACT_DEPTH)
+                    cached = self.impacts[term_ids[0]] = (rows[top], hit_scores[top])
+                rows, hit_scores = cached
+                return [(self.ids[row], float(score)) for row, score in zip(rows[:top_k], hit_scores[:top_k])]
+
+            if len(self.scores) < len(self.ids):
+                self.scores = np.zeros(max(len(self.ids), 2 * len(self.scores)), dtype=np.float32)
+            scores = self.scores
+            touched = []
+            try:
+                for term_id in term_ids:
+                    rows, term_scores = self._score_term(term_id, alive, lengths, avg_length, k1, b)
+                    # Every term adds a positive score, so a zero marks a row not seen yet
+                    touched.append(rows[scores[rows] == 0])
+                    scores[rows] += term_scores
+                rows = np.concatenate(touched)
+                hit_scores = scores[rows]
+            finally:
+                for rows_seen in touched:
+                    scores[rows_seen] = 0
+
+            top = self._top(hit_scores, top_k)
+            return [(self.ids[rows[i]], float(hit_scores[i])) for i in top]
+
+    @staticmethod
+    def _top(scores, k):
+        """Positions of the k highest scores, best first"""
+        k = min(k, len(scores))
+        if k < len(scores):
+            top = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top])]
+
+class LexicalIndex:
+    """Per-user BM25 indexes over DocumentChunk.chunk_text, keyed by embedding_id.
+
+    Every worker process holds its own copy of a partition. A save takes
+    an flock and first folds in any newer copy another process saved, so
+    no process overwrites what others indexed; readers pick up a newer
+    copy on their next call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.partitions = {}
+        self.user_locks = {}
+        self.lock = threading.Lock()
+
+    def partition(self, user_id, create=True):
+        """The user's partition, read from disk the first time it is asked for"""
+        partition = self.partitions.get(user_id)
+        if partition is not None:
+            self.refresh(user_id, partition)
+            return partition
+        with self.lock:
+            partition = self.partitions.get(user_id)
+            if partition is None:
+                partition = self._read(user_id)
+                if partition is None and create:
+                    partition = LexicalPartition()
+                if partition is not None:
+                    self.partitions[user_id] = partition
+            return partition
+
+    def refresh(self, user_id, partition):
+        """Switch to a copy of the partition another process saved since this one last read or wrote it"""
+        if self._version(user_id) == partition.version:
+            return
+        with self._user_lock(user_id):
+            version = self._version(user_id)
+            if version is not None and version != partition.version:
+                partition.take_over(self._read(user_id))
+
+    def add(self, user_id, ids, texts):
+        if ids:
+            self.partition(user_id).add(ids, texts)
+
+    def remove(self, user_id, ids):
+        partition = self.partition(user_id, create=False)
+        if partition is not None:
+            partition.remove(ids)
+
+    def ids(self, user_id, prefix=""):
+        partition = self.partition(user_id, create=False)
+        if partition is None:
+            return []
+        with partition.lock:
+            return [embedding_id for embedding_id in partition.rows if embedding_id.startswith(prefix)]
+
+    def search(self, user_id, query, top_k=3):
+        partition = self.partition(user_id, create=False)
+        if partition is None:
+            return []
+        return partition.search(query, top_k)
+
+    def save(self, user_id):
+        partition = self.partitions.get(user_id)
+        if partition is None:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with self._user_lock(user_id), self._saving(user_id):
+            self.refresh(user_id, partition)
+            state, done = partition.snapshot()
+            # The indexer thread and a failed job's callback may save the same user at once
+            fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=f"{user_id}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_path, self._path(user_id))
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            partition.saved(self._version(user_id), done)
+
+    def _user_lock(self, user_id):
+        with self.lock:
+            return self.user_locks.setdefault(user_id, threading.RLock())
+
+    @contextmanager
+    def _saving(self, user_id):
+        """Keep other processes from saving the user's partition meanwhile"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.path, f"{user_id}.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, user_id):
+        return os.path.join(self.path, f"{user_id}.pkl")
+
+    def _version(self, user_id):
+        try:
+            stat = os.stat(self._path(user_id))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self, user_id):
+        version = self._version(user_id)
+        if version is None:
+            return None
+        with open(self._path(user_id), "rb") as f:
+            state = pickle.load(f)
+        if not isinstance(state, LexicalPartition):
+            state = LexicalPartition.from_snapshot(state)
+        state.version = version
+        return state
+
+    def load(self):
+        """Read every saved partition now rather than on first use"""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            if name.endswith(".pkl"):
+                self.partition(int(name[:-len(".pkl")]), create=False)
+        logger.info(f"Loaded lexical index for {len(self.partitions)} users")
+
+def reciprocal_rank_fusion(rankings, k=None):
+    """Fuse ranked (id, score) lists into one list ordered by sum of 1 / (k + rank)"""
+    k = config.RRF_K if k is None else k
+    fused = {}
+    for ranking in rankings:
+        for rank, (embedding_id, _) in enumerate(ranking):
+            fused[embedding_id] = fused.get(embedding_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+lexical_index = LexicalIndex(config.LEXICAL_DIR)
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import random
+
+import httpx
+
+from app.config import config, logger
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+class LLMError(Exception):
+    pass
+
+class LLMClient:
+    """Async client for an OpenAI-compatible chat completions API.
+
+    One pooled httpx client is shared by every request, so connections
+    (and their TLS sessions) are reused across chat turns. At most
+    `max_concurrency` calls are in flight; the rest wait for a slot.
+    Connection errors, timeouts and retryable statuses are retried with
+    exponential backoff and full jitter. A stream is only retried until
+    its first token has been sent on.
+    """
+
+    def __init__(self, api_key, model, max_concurrency, retries):
+        self.api_key = api_key
+        self.model = model
+        self.retries = retries
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = None
+        self.mock_server = None
+
+    def start(self):
+        base_url = config.LLM_BASE_URL
+        if not base_url:
+            if config.USE_MOCK:
+                from app.mock_llm import MockServer
+
+                self.mock_server = MockServer()
+                base_url = self.mock_server.start()
+            else:
+                base_url = "https://api.openai.com/v1"
+
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(config.LLM_TIMEOUT, connect=config.LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=config.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=config.LLM_MAX_CONNECTIONS,
+                keepalive_expiry=config.LLM_KEEPALIVE
+            )
+        )
+        logger.info(f"LLM client using {base_url} with model {self.model}")
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+        if self.mock_server:
+            self.mock_server.stop()
+
+    def _payload(self, messages, max_tokens, stream):
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    async def _backoff(self, attempt, response=None):
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after and retry_after.replace(".", "", 1).isdigit():
+            # A provider asking for minutes would otherwise hold the chat slot that long
+            delay = min(float(retry_after), config.LLM_BACKOFF_MAX)
+        else:
+            delay = random.uniform(0, min(config.LLM_BACKOFF_MAX, config.LLM_BACKOFF_BASE * 2 ** attempt))
+        await asyncio.sleep(delay)
+
+    async def complete(self, messages, max_tokens):
+        """Returns {"content", "prompt_tokens", "completion_tokens"}"""
+        payload = self._payload(messages, max_tokens, stream=False)
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                last = attempt == self.retries
+                try:
+                    response = await self.client.post("/chat/completions", json=payload)
+                except httpx.TransportError as e:
+                    if last:
+                        raise LLMError(f"LLM request failed: {e}")
+                    logger.warning(f"LLM request failed, retrying: {e}")
+                    await self._backoff(attempt)
+                    continue
+                if response.status_code in RETRY_STATUSES and not last:
+                    logger.warning(f"LLM returned {response.status_code}, retrying")
+                    await self._backoff(attempt, response)
+                    continue
+                if response.status_code != 200:
+                    raise LLMError(f"LLM returned {response.status_code}: {response.text[:200]}")
+                data = response.json()
+                usage = data.get("usage") or {}
+                return {
+                    "content": data["choices"][0]["message"]["content"] or "",
+                    "prompt_tokens": usage.get("prompt_tokens"),
+                    "completion_tokens": usage.get("completion_tokens")
+                }
+
+    async def stream(self, messages, max_tokens, usage=None):
+        """Yield content deltas; the provider's token usage is put in `usage` if given"""
+        payload = self._payload(messages, max_tokens, stream=True)
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                last = attempt == self.retries
+                started = False
+                try:
+                    async with self.client.stream("POST", "/chat/completions", json=payload) as response:
+                        if response.status_code in RETRY_STATUSES and not last:
+                            logger.warning(f"LLM returned {response.status_code}, retrying")
+                            await response.aclose()
+                            await self._backoff(attempt, response)
+                            continue
+                        if response.status_code != 200:
+                            await response.aread()
+                            raise LLMError(f"LLM returned {response.status_code}: {response.text[:200]}")
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[5:].strip()
+                            if data == "[DONE]":
+                                # Read to the end so the connection goes back to the pool
+                                continue
+                            chunk = json.loads(data)
+                            if chunk.get("usage") and usage is not None:
+                                usage.update(chunk["usage"])
+                            for choice in chunk.get("choices") or []:
+                                content = choice.get("delta", {}).get("content")
+                                if content:
+                                    started = True
+                                    yield content
+                    return
+                except httpx.TransportError as e:
+                    if started or last:
+                        raise LLMError(f"LLM stream failed: {e}")
+                    logger.warning(f"LLM stream failed, retrying: {e}")
+                    await self._backoff(attempt)
+
+llm_client = LLMClient(config.OPENAI_KEY, config.AI_MODEL, config.LLM_MAX_CONCURRENCY, config.LLM_RETRIES)
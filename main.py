@@ -1,16 +1,43 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import or_, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
 import os
+import re
+import json
+import logging
+import base64
+import hashlib
+import threading
+import time
 import uuid
 
+from app import serialization, structured_logging
 from app.config import config, logger
-from app.database import get_db, init_db, User, ChatHistory, Document
-from app.auth import get_current_user, create_access_token, authenticate_user, get_password_hash, create_test_user
+from app.database import SessionLocal, get_async_db, init_db, async_engine, AsyncSessionLocal, upsert, User, ChatHistory, ChatSession, Document
+from app.auth import (
+    get_current_user, create_access_token, authenticate_user, get_password_hash, create_test_user,
+    password_pool, PasswordPoolBusy, token_cache
+)
 from app.document_processor import doc_processor
+from app.jobs import ingestion_queue, QueueFull, UserQueueFull
+from app.llm_client import llm_client
 from app.rag_chatbot import rag_bot
+from app.rate_limit import rate_limited, chat_scheduler, token_budget, Overloaded
+from app.response_cache import response_cache
+from app.session_memory import session_memory
+from app.lexical_index import lexical_index
+from app.metrics import metrics, profiler
+from app.structured_logging import start_request
+from app.micro_batcher import query_batcher
+from app.reranker import reranker
+from app.embeddings import embedder
+from app.context_builder import tokenizer
+from app.vector_store import vector_index
 
 app = FastAPI(
     title="AI Chatbot with RAG",
@@ -20,40 +47,87 @@ app = FastAPI(
 
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
+access_logger = logging.getLogger("app.access")
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+warmup_lock = threading.Lock()
+warmup_timings = {}
+
+def warm_up():
+    """Load what otherwise loads on first use; returns milliseconds per component"""
+    with warmup_lock:
+        if not warmup_timings:
+            steps = [
+                ("tokenizer", tokenizer.load),
+                ("embedder", lambda: embedder.embed(["warm up"])),
+                ("reranker", reranker.load if reranker else lambda: None),
+                ("vector_index", vector_index.load),
+                ("lexical_index", lexical_index.load)
+            ]
+            for name, step in steps:
+                start = time.perf_counter()
+                step()
+                warmup_timings[name] = round((time.perf_counter() - start) * 1000, 1)
+            logger.info(f"Warm-up finished: {warmup_timings}")
+        return dict(warmup_timings)
 
 @app.on_event("startup")
 def startup_event():
-    init_db()
-    
-    db = next(get_db())
-    create_test_user(db)
-    logger.info("Application started")
+    start = time.perf_counter()
+    if config.DB_BOOTSTRAP:
+        init_db()
+        db = SessionLocal()
+        try:
+            create_test_user(db)
+        finally:
+            db.close()
+    # Indexes, the tokenizer and reranker models load on first use or on /api/warmup
+    ingestion_queue.start()
+    ingestion_queue.resume()
+    llm_client.start()
+    if config.PROFILER_INTERVAL:
+        profiler.start()
+    if config.WARMUP_ON_START:
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    app.state.ready = True
+    logger.info(f"Application started in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.ready = False
+    ingestion_queue.shutdown()
+    await llm_client.close()
+    await async_engine.dispose()
 
 @app.post("/api/auth/register")
 async def register(
     username: str = Form(...),
     email: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    existing_user = db.query(User).filter(
-        (User.username == username) | (User.email == email)
-    ).first()
+    result = await db.execute(
+        select(User.id).filter(or_(User.username == username, User.email == email)).limit(1)
+    )
     
-    if existing_user:
+    if result.first():
         raise HTTPException(status_code=400, detail="Username or email exists")
     
+    try:
+        password_hash = await password_pool.run(get_password_hash, password)
+    except PasswordPoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    
     new_user = User(
         username=username,
         email=email,
-        password_hash=get_password_hash(password)
+        password_hash=password_hash
     )
     
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
     
-    access_token = create_access_token(data={"sub": username})
+    access_token = create_access_token(data={"sub": username, "uid": new_user.id})
     
     return {
         "message": "User created",
@@ -66,9 +140,12 @@ async def register(
 async def login(
     username: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db, username, password)
+    try:
+        user = await authenticate_user(db, username, password)
+    except PasswordPoolBusy as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     
     if not user:
         raise HTTPException(
@@ -76,7 +153,7 @@ async def login(
             detail="Incorrect username or password"
         )
     
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     
     return {
         "message": "Login successful",
@@ -85,54 +162,121 @@ async def login(
         "token_type": "bearer"
     }
 
-@app.post("/api/chat")
+async def prepare_chat(message, current_user, db):
+    user_message = message.get("message", "").strip()
+    session_id = message.get("session_id", str(uuid.uuid4()))
+    
+    if not user_message:
+        raise HTTPException(status_code=400, detail="Message empty")
+    
+    user_chat = ChatHistory(
+        user_id=current_user.id,
+        session_id=session_id,
+        message=user_message,
+        is_user=True
+    )
+    db.add(user_chat)
+    
+    with metrics.span("chat.retrieval"):
+        relevant_docs = await doc_processor.search(user_message, current_user.id, config.RETRIEVAL_TOP_K)
+    
+    chat_history = session_memory.get(current_user.id, session_id)
+    metrics.inc("session_memory_total", result="miss" if chat_history is None else "hit")
+    if chat_history is None:
+        with metrics.span("chat.history"):
+            result = await db.execute(
+                select(ChatHistory).filter(
+                    ChatHistory.user_id == current_user.id,
+                    ChatHistory.session_id == session_id
+                ).order_by(ChatHistory.created_at.desc()).limit(config.SESSION_MEMORY_TURNS)
+            )
+            recent_chats = result.scalars().all()
+        
+        chat_history = [
+            {"message": chat.message, "is_user": chat.is_user}
+            for chat in reversed(recent_chats)
+        ]
+        session_memory.load(current_user.id, session_id, chat_history)
+    return user_message, session_id, relevant_docs, chat_history
+
+async def save_bot_message(db, user_id, session_id, user_message, bot_response):
+    tokens_used = bot_response.get("tokens_used", 0)
+    bot_chat = ChatHistory(
+        user_id=user_id,
+        session_id=session_id,
+        message=bot_response["response"],
+        is_user=False,
+        tokens_used=tokens_used,
+        source_documents=serialization.dumps(bot_response.get("sources", [])).decode()
+    )
+    db.add(bot_chat)
+    
+    # Keep the session summary in step with the turn, in the same transaction.
+    # An upsert, so two first turns of a session cannot both insert it.
+    now = datetime.utcnow()
+    preview = bot_response["response"][:config.SESSION_PREVIEW_CHARS]
+    await db.execute(
+        upsert(ChatSession).values(
+            user_id=user_id,
+            session_id=session_id,
+            title=user_message[:config.SESSION_PREVIEW_CHARS],
+            last_message=preview,
+            message_count=2,
+            total_tokens=tokens_used,
+            created_at=now,
+            updated_at=now
+        ).on_conflict_do_update(
+            index_elements=[ChatSession.user_id, ChatSession.session_id],
+            set_={
+                "last_message": preview,
+                "message_count": ChatSession.message_count + 2,
+                "total_tokens": ChatSession.total_tokens + tokens_used,
+                "updated_at": now
+            }
+        )
+    )
+    
+    await db.commit()
+    token_budget.spend(user_id, tokens_used)
+    session_memory.append(
+        user_id,
+        session_id,
+        {"message": user_message, "is_user": True},
+        {"message": bot_response["response"], "is_user": False}
+    )
+    return bot_chat
+
+chat_rate_limit = rate_limited("chat", config.CHAT_RATE, config.CHAT_BURST)
+upload_rate_limit = rate_limited("upload", config.UPLOAD_RATE, config.UPLOAD_BURST)
+
+@app.post("/api/chat", dependencies=[Depends(chat_rate_limit)])
 async def chat(
     request: Request,
     message: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        user_message = message.get("message", "").strip()
-        session_id = message.get("session_id", str(uuid.uuid4()))
-        
-        if not user_message:
-            raise HTTPException(status_code=400, detail="Message empty")
-        
-        user_chat = ChatHistory(
-            user_id=current_user.id,
-            session_id=session_id,
-            message=user_message,
-            is_user=True
-        )
-        db.add(user_chat)
-        
-        relevant_docs = doc_processor.search_documents(user_message, current_user.id)
-        
-        recent_chats = db.query(ChatHistory).filter(
-            ChatHistory.user_id == current_user.id,
-            ChatHistory.session_id == session_id
-        ).order_by(ChatHistory.created_at.desc()).limit(5).all()
-        
-        bot_response = rag_bot.generate_response(
-            query=user_message,
-            context=relevant_docs,
-            chat_history=[
-                {"message": chat.message, "is_user": chat.is_user}
-                for chat in reversed(recent_chats)
-            ]
-        )
-        
-        bot_chat = ChatHistory(
-            user_id=current_user.id,
-            session_id=session_id,
-            message=bot_response["response"],
-            is_user=False,
-            tokens_used=bot_response.get("tokens_used", 0),
-            source_documents=str(bot_response.get("sources", []))
-        )
-        db.add(bot_chat)
-        db.commit()
+        async with chat_scheduler.slot(current_user.id):
+            await token_budget.check(db, current_user.id)
+            user_message, session_id, relevant_docs, chat_history = await prepare_chat(message, current_user, db)
+            # Give the connection back while the model answers
+            with metrics.span("chat.commit"):
+                await db.commit()
+            
+            bot_response = response_cache.get(current_user.id, user_message, relevant_docs, chat_history)
+            if bot_response is None:
+                with metrics.span("chat.generate"):
+                    bot_response = await rag_bot.generate_response(
+                        query=user_message,
+                        context=relevant_docs,
+                        chat_history=chat_history
+                    )
+                response_cache.put(current_user.id, user_message, relevant_docs, bot_response, chat_history)
+            
+            with metrics.span("chat.save"):
+                bot_chat = await save_bot_message(db, current_user.id, session_id, user_message, bot_response)
+            metrics.inc("chat_tokens_total", bot_response.get("tokens_used", 0))
         
         return {
             "response": bot_response["response"],
@@ -141,43 +285,259 @@ async def chat(
             "message_id": bot_chat.id
         }
     
+    except HTTPException:
+        raise
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"Chat error: {e}")
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/chat/history")
-async def get_chat_history(
-    session_id: str = None,
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+@app.post("/api/chat/stream", dependencies=[Depends(chat_rate_limit)])
+async def chat_stream(
+    request: Request,
+    message: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(ChatHistory).filter(ChatHistory.user_id == current_user.id)
+    """Same as /api/chat, but sends the answer as Server-Sent Events while it is generated"""
+    user_id = current_user.id
+    try:
+        await chat_scheduler.acquire(user_id)
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
     
-    if session_id:
-        query = query.filter(ChatHistory.session_id == session_id)
+    # The slot is held until the stream finishes
+    try:
+        await token_budget.check(db, user_id)
+        user_message, session_id, relevant_docs, chat_history = await prepare_chat(message, current_user, db)
+        await db.commit()
+    except HTTPException:
+        chat_scheduler.release(user_id)
+        raise
+    except Exception as e:
+        chat_scheduler.release(user_id)
+        logger.error(f"Chat error: {e}")
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
     
-    chats = query.order_by(ChatHistory.created_at.asc()).all()
+    async def event_stream():
+        # The request's session is closed once the response starts, so the
+        # bot message is saved through a session owned by the stream
+        stream_db = AsyncSessionLocal()
+        try:
+            bot_response = response_cache.get(user_id, user_message, relevant_docs, chat_history)
+            if bot_response is not None:
+                yield sse_event({"token": bot_response["response"]})
+            else:
+                prompt = rag_bot.build_prompt(user_message, relevant_docs, chat_history)
+                parts = []
+                usage = {}
+                start = time.perf_counter()
+                async for token in rag_bot.stream_response(prompt, usage):
+                    if not parts:
+                        metrics.stage("chat.first_token", time.perf_counter() - start)
+                    parts.append(token)
+                    yield sse_event({"token": token})
+                metrics.stage("chat.generate", time.perf_counter() - start)
+                
+                bot_response = rag_bot.make_result("".join(parts), prompt, usage)
+                response_cache.put(user_id, user_message, relevant_docs, bot_response, chat_history)
+            
+            with metrics.span("chat.save"):
+                bot_chat = await save_bot_message(stream_db, user_id, session_id, user_message, bot_response)
+            metrics.inc("chat_tokens_total", bot_response.get("tokens_used", 0))
+            
+            yield sse_event({
+                "session_id": session_id,
+                "sources": bot_response.get("sources", []),
+                "message_id": bot_chat.id
+            }, event="done")
+        except Exception as e:
+            logger.error(f"Chat stream error: {e}")
+            await stream_db.rollback()
+            yield sse_event({"detail": str(e)}, event="error")
+        finally:
+            chat_scheduler.release(user_id)
+            await stream_db.close()
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/chat/sessions")
+async def get_chat_sessions(
+    limit: int = Query(config.HISTORY_PAGE_SIZE, ge=1, le=config.HISTORY_MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await db.execute(
+        select(ChatSession).filter(
+            ChatSession.user_id == current_user.id
+        ).order_by(ChatSession.updated_at.desc()).limit(limit)
+    )
     
     return {
-        "chats": [
+        "sessions": [
             {
-                "id": chat.id,
-                "message": chat.message,
-                "is_user": chat.is_user,
-                "created_at": chat.created_at.isoformat(),
-                "sources": eval(chat.source_documents) if chat.source_documents else []
+                "session_id": session.session_id,
+                "title": session.title,
+                "last_message": session.last_message,
+                "message_count": session.message_count,
+                "total_tokens": session.total_tokens,
+                "created_at": session.created_at.isoformat(),
+                "updated_at": session.updated_at.isoformat()
             }
-            for chat in chats
+            for session in result.scalars().all()
         ]
     }
 
-@app.post("/api/documents/upload")
+def encode_cursor(chat):
+    raw = f"{chat.created_at.isoformat()}|{chat.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        created_at, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(chat_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def encode_chat(chat):
+    return serialization.dumps({
+        "id": chat.id,
+        "message": chat.message,
+        "is_user": chat.is_user,
+        "created_at": chat.created_at.isoformat(),
+        "sources": serialization.decode_sources(chat.source_documents)
+    })
+
+@app.get("/api/chat/history")
+async def get_chat_history(
+    session_id: str = None,
+    cursor: str = None,
+    limit: int = Query(config.HISTORY_PAGE_SIZE, ge=1, le=config.HISTORY_MAX_PAGE_SIZE),
+    current_user: User = Depends(get_current_user)
+):
+    """One page of history, oldest first; pass next_cursor back to get the following page"""
+    query = select(ChatHistory).filter(ChatHistory.user_id == current_user.id)
+    
+    if session_id:
+        query = query.filter(ChatHistory.session_id == session_id)
+    
+    if cursor:
+        query = query.filter(
+            tuple_(ChatHistory.created_at, ChatHistory.id) > tuple_(*decode_cursor(cursor))
+        )
+    
+    # One extra row tells us whether there is a next page
+    query = query.order_by(ChatHistory.created_at.asc(), ChatHistory.id.asc()).limit(limit + 1)
+    
+    async def encode_page():
+        # Rows are streamed straight from the cursor and encoded in batches,
+        # so large pages are never built up as one Python object
+        last = None
+        count = 0
+        separator = b""
+        yield b'{"chats":['
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(query)
+            async for partition in result.scalars().partitions(100):
+                rows = []
+                for chat in partition:
+                    count += 1
+                    if count > limit:
+                        break
+                    rows.append(encode_chat(chat))
+                    last = chat
+                if rows:
+                    yield separator + b",".join(rows)
+                    separator = b","
+        next_cursor = encode_cursor(last) if count > limit else None
+        yield b'],"next_cursor":' + serialization.dumps(next_cursor) + b"}"
+    
+    return StreamingResponse(encode_page(), media_type="application/json")
+
+async def save_upload(file, file_path):
+    """Copy an upload to disk block by block, enforcing MAX_SIZE and hashing as it goes"""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(file_path, "wb") as f:
+            while True:
+                block = await file.read(config.UPLOAD_BLOCK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > config.MAX_SIZE:
+                    raise HTTPException(status_code=413, detail="File too large")
+                digest.update(block)
+                await run_in_threadpool(f.write, block)
+    except BaseException:
+        os.remove(file_path)
+        raise
+    return digest.hexdigest()
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    request_id = request.headers.get("x-request-id", "")
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    context = start_request(request_id)
+    response = await call_next(request)
+    # For streamed responses this is the time to the first byte
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.observe("http_request_seconds", time.perf_counter() - start, method=request.method, route=path)
+    metrics.inc("http_requests_total", method=request.method, route=path, status=response.status_code)
+    response.headers["X-Request-ID"] = request_id
+    
+    body = response.body_iterator
+    
+    async def log_when_sent():
+        # Logged after the last byte, so streamed chats include their generation stages
+        async for chunk in body:
+            yield chunk
+        elapsed = (time.perf_counter() - start) * 1000
+        access_logger.info(
+            f"{request.method} {request.url.path} {response.status_code} {elapsed:.1f}ms",
+            extra={"fields": {
+                "method": request.method,
+                "route": path,
+                "status": response.status_code,
+                "duration_ms": round(elapsed, 2),
+                "stages": {stage: round(seconds * 1000, 2) for stage, seconds in context["stages"].items()}
+            }}
+        )
+    
+    response.body_iterator = log_when_sent()
+    return response
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Reject oversized uploads from the header before the body is parsed
+    if request.url.path == "/api/documents/upload":
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > config.MAX_SIZE + config.UPLOAD_BLOCK_SIZE:
+            return JSONResponse(status_code=413, content={"detail": "File too large"})
+    return await call_next(request)
+
+@app.post("/api/documents/upload", status_code=202, dependencies=[Depends(upload_rate_limit)])
 async def upload_document(
+    response: Response,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
+    reserved = False
     try:
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file")
@@ -196,38 +556,134 @@ async def upload_document(
             f"{current_user.id}_{uuid.uuid4()}_{file.filename}"
         )
         
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        # Held across the save below, so concurrent uploads cannot all pass the limits
+        try:
+            ingestion_queue.reserve(current_user.id)
+        except UserQueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        except QueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        reserved = True
         
-        document = doc_processor.process_document(
-            user_id=current_user.id,
-            file_path=file_path,
-            original_filename=file.filename
+        content_hash = await save_upload(file, file_path)
+        
+        result = await db.execute(
+            doc_processor.existing_query(current_user.id, file.filename, content_hash)
         )
+        existing = result.scalars().first()
+        if existing and existing.content_hash == content_hash:
+            duplicate = existing
+            os.remove(file_path)
+            # Nothing was queued
+            response.status_code = 200
+            return {
+                "message": "Document already uploaded",
+                "job_id": duplicate.id,
+                "duplicate": True,
+                "document": {
+                    "id": duplicate.id,
+                    "filename": duplicate.original_filename,
+                    "chunks": duplicate.chunk_count,
+                    "status": duplicate.status,
+                    "uploaded_at": duplicate.uploaded_at.isoformat()
+                }
+            }
+        
+        if existing:
+            if existing.status != "processed" or ingestion_queue.status(existing.id):
+                os.remove(file_path)
+                raise HTTPException(status_code=409, detail="An earlier version is still processing, try again later")
+            # A new version of a known file: only its changed chunks are re-indexed
+            document = await run_in_threadpool(
+                doc_processor.replace_file, existing.id, file_path, content_hash, ingestion_queue.owner
+            )
+        else:
+            document = await run_in_threadpool(
+                doc_processor.create_document,
+                user_id=current_user.id,
+                file_path=file_path,
+                original_filename=file.filename,
+                content_hash=content_hash,
+                owner=ingestion_queue.owner
+            )
+        
+        reserved = False
+        try:
+            job = ingestion_queue.submit(document, reserved=True)
+        except Exception as e:
+            logger.error(f"Could not queue document {document.id}: {e}")
+            await run_in_threadpool(doc_processor.mark_failed, document.id, str(e))
+            raise HTTPException(status_code=503, detail="Document processing is unavailable, try again later")
         
         return {
-            "message": "Document uploaded",
+            "message": "Document queued",
+            "job_id": document.id,
             "document": {
                 "id": document.id,
                 "filename": document.original_filename,
                 "chunks": document.chunk_count,
+                "status": job["status"],
                 "uploaded_at": document.uploaded_at.isoformat()
             }
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if reserved:
+            ingestion_queue.release(current_user.id)
+
+@app.get("/api/documents/{document_id}/status")
+async def get_document_status(
+    document_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    result = await db.execute(
+        select(Document).filter(
+            Document.id == document_id,
+            Document.user_id == current_user.id
+        )
+    )
+    document = result.scalars().first()
+    
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    job = ingestion_queue.status(document_id)
+    if job:
+        return {
+            "id": document_id,
+            "status": job["status"],
+            "progress": round(job["progress"], 3),
+            "chunks": job["chunks"],
+            "processed": False,
+            "error": job["error"]
+        }
+    
+    return {
+        "id": document_id,
+        "status": document.status,
+        "progress": 1.0 if document.is_processed else 0.0,
+        "chunks": document.chunk_count,
+        "processed": document.is_processed,
+        "error": document.error
+    }
 
 @app.get("/api/documents")
 async def get_documents(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    documents = db.query(Document).filter(
-        Document.user_id == current_user.id
-    ).order_by(Document.uploaded_at.desc()).all()
+    result = await db.execute(
+        select(Document).filter(
+            Document.user_id == current_user.id
+        ).order_by(Document.uploaded_at.desc())
+    )
+    documents = result.scalars().all()
     
     return {
         "documents": [
@@ -238,6 +694,7 @@ async def get_documents(
                 "file_size": doc.file_size,
                 "chunks": doc.chunk_count,
                 "processed": doc.is_processed,
+                "status": doc.status,
                 "uploaded_at": doc.uploaded_at.isoformat()
             }
             for doc in documents
@@ -256,12 +713,67 @@ async def chat_page(request: Request):
 async def admin_page(request: Request):
     return templates.TemplateResponse("admin.html", {"request": request})
 
+metrics.gauge("ingest_pending_jobs", ingestion_queue.pending, "Documents queued or being processed")
+metrics.gauge("password_queue_depth", password_pool.depth, "Password checks waiting for a worker")
+metrics.gauge("password_rejected_total", lambda: password_pool.rejected)
+metrics.gauge("chat_active", lambda: chat_scheduler.total, "Chat turns holding a slot")
+metrics.gauge("chat_waiting", lambda: sum(len(queue) for queue in chat_scheduler.waiting.values()))
+metrics.gauge("db_connections_in_use", lambda: async_engine.pool.checkedout())
+metrics.gauge("response_cache_hits", lambda: response_cache.hits)
+metrics.gauge("response_cache_misses", lambda: response_cache.misses)
+metrics.gauge("embedding_cache_hits", lambda: embedder.hits)
+metrics.gauge("embedding_cache_misses", lambda: embedder.misses)
+metrics.gauge("embedding_batch_size_mean", query_batcher.mean_batch_size)
+metrics.gauge("rerank_budget_exceeded", lambda: reranker.timeouts if reranker else 0)
+metrics.gauge("token_cache_entries", lambda: len(token_cache.entries))
+metrics.gauge("log_queue_depth", lambda: structured_logging.queue_handler.queue.qsize())
+metrics.gauge("log_records_dropped", lambda: structured_logging.queue_handler.dropped, "Log records dropped because the log queue was full")
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Prometheus text exposition of the in-process metrics"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/metrics/profile")
+async def get_profile(
+    reset: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    """Collapsed stacks from the sampling profiler, for flame graph tools"""
+    if not profiler.running:
+        raise HTTPException(status_code=404, detail="Profiler is not enabled, set PROFILER_INTERVAL")
+    return Response(profiler.collapsed(reset), media_type="text/plain")
+
+@app.post("/api/warmup")
+async def warmup():
+    """Load indexes and models now instead of on the first requests that need them"""
+    return {"status": "warm", "timings_ms": await run_in_threadpool(warm_up)}
+
+@app.get("/api/health/live")
+async def liveness_check():
+    """The process is up and serving; says nothing about its dependencies"""
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    """Startup has finished and the database answers; safe to send traffic"""
+    if not getattr(app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="Not ready")
+    try:
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    except Exception as e:
+        logger.error(f"Readiness check failed: {e}")
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ready", "warm": bool(warmup_timings)}
+
 @app.get("/api/health")
 async def health_check():
     return {
         "status": "healthy",
         "service": "rag-chatbot",
-        "version": "1.0.0"
+        "version": "1.0.0",
+        "password_queue": password_pool.depth()
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as TallyCounter
+
+from app.config import config, logger
+from app.structured_logging import add_stage
+
+# Latency buckets in seconds, 0.5 ms to 60 s
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Histogram:
+    """Cumulative bucket counts, like a Prometheus histogram; quantiles are
+    interpolated within the bucket they fall in"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.count
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+class Span:
+    __slots__ = ("histogram", "stage", "start")
+
+    def __init__(self, histogram, stage):
+        self.histogram = histogram
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.histogram.observe(seconds)
+        add_stage(self.stage, seconds)
+        return False
+
+class Metrics:
+    """In-process metrics registry rendered in the Prometheus text format.
+
+    Histograms and counters are keyed by name and a sorted label tuple.
+    Gauges are functions read at scrape time, so queue depths cost
+    nothing between scrapes.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def histogram(self, name, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, func, help_text=""):
+        self.gauges[name] = func
+        if help_text:
+            self.help[name] = help_text
+
+    def _stage_histogram(self, stage):
+        histogram = self.spans.get(stage)
+        if histogram is None:
+            histogram = self.spans[stage] = self.histogram("stage_seconds", stage=stage)
+        return histogram
+
+    def span(self, stage):
+        """Time a block into the stage_seconds histogram and the request's log context"""
+        return Span(self._stage_histogram(stage), stage)
+
+    def stage(self, stage, seconds):
+        self._stage_histogram(stage).observe(seconds)
+        add_stage(stage, seconds)
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {self.prefix}{name} {self.help[name]}")
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            with histogram.lock:
+                counts = list(histogram.counts)
+                total = histogram.count
+                value_sum = histogram.sum
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.prefix}{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{format_labels(labels)} {value_sum}")
+            lines.append(f"{self.prefix}{name}_count{format_labels(labels)} {total}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            quantile_name = f"{name}_quantile"
+            header(quantile_name, "gauge")
+            for q in QUANTILES:
+                lines.append(
+                    f"{self.prefix}{quantile_name}{format_labels(labels + (('quantile', str(q)),))} "
+                    f"{histogram.quantile(q)}"
+                )
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{self.prefix}{name}{format_labels(labels)} {value}")
+
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+                continue
+            header(name, "gauge")
+            lines.append(f"{self.prefix}{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+class SamplingProfiler:
+    """Samples the stack of one thread every `interval` seconds.
+
+    Stacks are tallied in the collapsed format flame graph tools read
+    ("outer;inner;leaf count"). Nothing runs unless it is started.
+    """
+
+    def __init__(self, interval, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = TallyCounter()
+        self.samples = 0
+        self.target = None
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self, thread_id=None):
+        if self.running:
+            return
+        self.target = thread_id or threading.get_ident()
+        self.running = True
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+        logger.info(f"Sampling profiler started, every {self.interval * 1000:.0f} ms")
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            with self.lock:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self, reset=False):
+        with self.lock:
+            stacks = self.stacks
+            if reset:
+                self.stacks = TallyCounter()
+                self.samples = 0
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+metrics = Metrics("rag_")
+profiler = SamplingProfiler(config.PROFILER_INTERVAL or 0.01)
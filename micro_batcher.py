@@ -0,0 +1,71 @@
+import asyncio
+
+from starlette.concurrency import run_in_threadpool
+
+from app.config import config
+from app.embeddings import embedder
+
+class MicroBatcher:
+    """Turns concurrent single-item calls into batched calls.
+
+    `func` takes a list of items and returns one result per item; it runs
+    in the threadpool. When no batch is running an item is sent at once,
+    so a quiet server adds no delay. While one is running, items collect
+    until `max_batch` of them are waiting, `max_wait` seconds have passed
+    or the running batch finishes, and then go out together.
+    """
+
+    def __init__(self, func, max_batch, max_wait):
+        self.func = func
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = []
+        self.timer = None
+        self.running = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if not self.running or len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self.running.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.running.discard(task)
+        if self.pending:
+            self._flush()
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        try:
+            results = await run_in_threadpool(self.func, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def mean_batch_size(self):
+        return self.items / self.batches if self.batches else 0.0
+
+query_batcher = MicroBatcher(embedder.embed, config.EMBED_MICROBATCH_SIZE, config.EMBED_MICROBATCH_WAIT)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from app.config import config, logger
+from app.context_builder import tokenizer
+
+TOKEN_RE = re.compile(r"\s*\S+\s*|\s+")
+EXCERPT_RE = re.compile(r"^\[\d+\] \([^)]*\) ", re.MULTILINE)
+
+mock_app = FastAPI(title="Mock LLM")
+
+def compose(query, excerpts):
+    """The keyword answers the chatbot gave before it called a model"""
+    context_text = ""
+    if excerpts:
+        context_text = "Based on your documents:\n"
+        for i, text in enumerate(excerpts[:2], 1):
+            context_text += f"{i}. {text}\n"
+
+    query_lower = query.lower()
+
+    if "hello" in query_lower or "hi" in query_lower:
+        response = "Hello! I'm your AI assistant. I can answer questions about your uploaded documents."
+    elif "service" in query_lower:
+        response = "Our services include: AI chatbot development, custom software solutions, and consulting."
+    elif "price" in query_lower or "cost" in query_lower:
+        response = "Pricing starts at $99/month for basic plans. Enterprise solutions are customized."
+    elif "contact" in query_lower:
+        response = "Contact us at: email@example.com or visit our website."
+    elif context_text:
+        response = f"{context_text}\nIs there anything specific you'd like to know?"
+    else:
+        response = f"I understand you're asking about '{query}'. You can upload documents for more specific answers."
+
+    return response
+
+def answer(messages):
+    query = messages[-1]["content"] if messages else ""
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    _, _, excerpts = system.partition("Document excerpts:\n")
+    excerpts = [text.strip() for text in EXCERPT_RE.split(excerpts) if text.strip()]
+    return compose(query, excerpts)
+
+def usage(messages, content):
+    prompt_tokens = 3 + sum(tokenizer.count(message["content"]) + 4 for message in messages)
+    completion_tokens = tokenizer.count(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+def jittered(delay):
+    return delay * random.uniform(0.5, 1.5)
+
+@mock_app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI-compatible chat completions with model-like latencies"""
+    body = await request.json()
+    messages = body.get("messages", [])
+    content = answer(messages)
+    tokens = TOKEN_RE.findall(content)[:body.get("max_tokens") or None]
+    content = "".join(tokens)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", config.AI_MODEL)
+
+    await asyncio.sleep(jittered(config.MOCK_LLM_TTFT))
+
+    if not body.get("stream"):
+        await asyncio.sleep(jittered(config.MOCK_LLM_TOKEN_DELAY) * len(tokens))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage(messages, content)
+        }
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+
+    async def events():
+        yield f"data: {json.dumps(chunk({'role': 'assistant'}))}\n\n"
+        for token in tokens:
+            yield f"data: {json.dumps(chunk({'content': token}))}\n\n"
+            await asyncio.sleep(jittered(config.MOCK_LLM_TOKEN_DELAY))
+        yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            final = chunk({})
+            final["choices"] = []
+            final["usage"] = usage(messages, content)
+            yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+class MockServer:
+    """Serves mock_app on a free localhost port from a background thread"""
+
+    def __init__(self):
+        self.server = None
+        self.thread = None
+        self.base_url = None
+
+    def start(self):
+        import uvicorn
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.base_url = f"http://127.0.0.1:{sock.getsockname()[1]}/v1"
+        self.server = uvicorn.Server(uvicorn.Config(mock_app, log_level="warning", lifespan="off"))
+        self.thread = threading.Thread(
+            target=self.server.run,
+            kwargs={"sockets": [sock]},
+            name="mock-llm",
+            daemon=True
+        )
+        self.thread.start()
+        while not self.server.started and self.thread.is_alive():
+            time.sleep(0.01)
+        logger.info(f"Mock LLM listening on {self.base_url}")
+        return self.base_url
+
+    def stop(self):
+        if self.server:
+            self.server.should_exit = True
+            self.thread.join(timeout=5)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(mock_app, host="127.0.0.1", port=8001)
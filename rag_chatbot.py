@@ -1,39 +1,39 @@
 from app.config import config, logger
+from app.context_builder import context_builder, tokenizer
+from app.llm_client import llm_client
 
 class RAGChatbot:
     def __init__(self):
         logger.info("RAG Chatbot ready")
     
-    def generate_response(self, query, context, chat_history=None):
+    def build_prompt(self, query, context, chat_history=None):
+        """Fit the top chunks and recent turns into the model's token budget"""
+        return context_builder.build(query, context, chat_history)
+    
+    async def generate_response(self, query, context, chat_history=None):
         """Generate intelligent responses"""
-        
-        # Prepare context
-        context_text = ""
-        if context:
-            context_text = "Based on your documents:\n"
-            for i, doc in enumerate(context[:2], 1):
-                context_text += f"{i}. {doc['text']}\n"
-        
-        # Generate response based on query
-        query_lower = query.lower()
-        
-        if "hello" in query_lower or "hi" in query_lower:
-            response = "Hello! I'm your AI assistant. I can answer questions about your uploaded documents."
-        elif "service" in query_lower:
-            response = "Our services include: AI chatbot development, custom software solutions, and consulting."
-        elif "price" in query_lower or "cost" in query_lower:
-            response = "Pricing starts at $99/month for basic plans. Enterprise solutions are customized."
-        elif "contact" in query_lower:
-            response = "Contact us at: email@example.com or visit our website."
-        elif context_text:
-            response = f"{context_text}\nIs there anything specific you'd like to know?"
-        else:
-            response = f"I understand you're asking about '{query}'. You can upload documents for more specific answers."
-        
+        prompt = self.build_prompt(query, context, chat_history)
+        completion = await llm_client.complete(prompt["messages"], config.MAX_OUTPUT_TOKENS)
+        return self.make_result(completion["content"], prompt, completion)
+    
+    async def stream_response(self, prompt, usage=None):
+        """Yield the response token by token as it is produced"""
+        async for token in llm_client.stream(prompt["messages"], config.MAX_OUTPUT_TOKENS, usage):
+            yield token
+    
+    def make_result(self, response, prompt, usage=None):
+        """Token counts come from the provider when it reports them, else from our tokenizer"""
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or prompt["prompt_tokens"]
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = tokenizer.count(response)
         return {
             "response": response,
-            "tokens_used": len(response.split()),
-            "sources": [doc['metadata'] for doc in context[:2]] if context else []
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_used": prompt_tokens + completion_tokens,
+            "sources": [doc['metadata'] for doc in prompt["context"]]
         }
 
 rag_bot = RAGChatbot()
\ No newline at end of file
@@ -0,0 +1,263 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, time as day_start
+
+from fastapi import Depends, HTTPException
+from sqlalchemy import func, select
+
+from app.auth import get_current_user
+from app.config import config, logger
+from app.database import ChatHistory
+from app.metrics import metrics
+
+class BucketBackend:
+    """Stores token buckets.
+
+    `take` spends `cost` tokens from the bucket at `key`, refilled at `rate`
+    tokens per second up to `burst`, and returns 0 when allowed or the
+    number of seconds until it would be.
+    """
+
+    async def take(self, key, rate, burst, cost=1):
+        raise NotImplementedError
+
+class MemoryBackend(BucketBackend):
+    """Buckets in this process; each worker process limits on its own"""
+
+    def __init__(self, max_keys=100_000):
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    async def take(self, key, rate, burst, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _, _ = self.buckets.get(key, (burst, now, rate, burst))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / rate
+            # Limiters with different rates share the dict, so each bucket keeps its own
+            self.buckets[key] = (tokens, now, rate, burst)
+            if len(self.buckets) > self.max_keys:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        # A bucket that has refilled completely is the same as no bucket
+        full = [
+            key for key, (tokens, updated, rate, burst) in self.buckets.items()
+            if tokens + (now - updated) * rate >= burst
+        ]
+        for key in full:
+            del self.buckets[key]
+
+REDIS_TAKE = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = clock[1] + clock[2] / 1000000
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBackend(BucketBackend):
+    """Buckets shared by every worker process, kept in Redis"""
+
+    def __init__(self, url):
+        import redis.asyncio
+
+        self.client = redis.asyncio.from_url(url)
+        self.script = self.client.register_script(REDIS_TAKE)
+
+    async def take(self, key, rate, burst, cost=1):
+        wait = await self.script(keys=[f"ratelimit:{key}"], args=[rate, burst, cost])
+        return float(wait)
+
+def get_backend():
+    if config.RATE_LIMIT_BACKEND == "redis":
+        try:
+            return RedisBackend(config.REDIS_URL)
+        except ImportError:
+            logger.warning("RATE_LIMIT_BACKEND is redis but the redis package is not installed, limiting in process")
+    return MemoryBackend()
+
+bucket_backend = get_backend()
+
+def rate_limited(name, rate, burst):
+    """Dependency allowing each user `rate` requests per second, in bursts of up to `burst`"""
+    async def check(current_user = Depends(get_current_user)):
+        wait = await bucket_backend.take(f"{name}:{current_user.id}", rate, burst)
+        if wait:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+    return check
+
+class Overloaded(Exception):
+    pass
+
+class FairScheduler:
+    """Shares a fixed number of concurrent slots between users.
+
+    A user holds at most `per_user` slots at once. When every slot is busy,
+    requests wait in a queue per user and freed slots go to the users in
+    turn, so one client sending many requests cannot push everyone else to
+    the back of the line. Lives on the event loop, so it needs no lock.
+    """
+
+    def __init__(self, capacity, per_user, max_waiting):
+        self.capacity = capacity
+        self.per_user = per_user
+        self.max_waiting = max_waiting
+        self.active = {}
+        self.total = 0
+        self.waiting = {}
+        self.turns = deque()
+
+    def _free(self, user_id):
+        return self.total < self.capacity and self.active.get(user_id, 0) < self.per_user
+
+    def _grant(self, user_id):
+        self.active[user_id] = self.active.get(user_id, 0) + 1
+        self.total += 1
+
+    async def acquire(self, user_id):
+        if self._free(user_id) and user_id not in self.waiting:
+            self._grant(user_id)
+            metrics.stage("chat.queue", 0.0)
+            return
+
+        queue = self.waiting.get(user_id)
+        if queue is None:
+            queue = self.waiting[user_id] = deque()
+            self.turns.append(user_id)
+        if len(queue) >= self.max_waiting:
+            raise Overloaded("Too many requests waiting, try again later")
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        try:
+            with metrics.span("chat.queue"):
+                await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the request went away
+                self.release(user_id)
+            else:
+                self._forget(user_id, future)
+            raise
+
+    def release(self, user_id):
+        self.active[user_id] -= 1
+        if not self.active[user_id]:
+            del self.active[user_id]
+        self.total -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for _ in range(len(self.turns)):
+            if self.total >= self.capacity:
+                return
+            user_id = self.turns[0]
+            self.turns.rotate(-1)
+            if not self._free(user_id):
+                continue
+            queue = self.waiting[user_id]
+            while queue and queue[0].done():
+                queue.popleft()
+            if queue:
+                self._grant(user_id)
+                queue.popleft().set_result(None)
+            if not queue:
+                del self.waiting[user_id]
+                self.turns.remove(user_id)
+
+    def _forget(self, user_id, future):
+        queue = self.waiting.get(user_id)
+        if queue is None:
+            return
+        if future in queue:
+            queue.remove(future)
+        if not queue:
+            del self.waiting[user_id]
+            self.turns.remove(user_id)
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release(user_id)
+
+chat_scheduler = FairScheduler(
+    config.CHAT_CONCURRENCY,
+    config.CHAT_USER_CONCURRENCY,
+    config.CHAT_USER_QUEUE
+)
+
+class TokenBudget:
+    """Daily cap on the tokens_used a user's chats may add up to.
+
+    Each user's total for the day is read from ChatHistory once and then
+    kept up to date in memory; with several worker processes each one
+    enforces the budget against what it has seen since that read.
+    """
+
+    def __init__(self, daily_limit):
+        self.daily_limit = daily_limit
+        self.day = None
+        self.used = {}
+        self.lock = threading.Lock()
+
+    def _today(self):
+        today = datetime.utcnow().date()
+        if today != self.day:
+            self.day = today
+            self.used = {}
+        return today
+
+    async def check(self, db, user_id):
+        if not self.daily_limit:
+            return
+        with self.lock:
+            today = self._today()
+            used = self.used.get(user_id)
+        if used is None:
+            result = await db.execute(
+                select(func.coalesce(func.sum(ChatHistory.tokens_used), 0)).filter(
+                    ChatHistory.user_id == user_id,
+                    ChatHistory.created_at >= datetime.combine(today, day_start.min)
+                )
+            )
+            with self.lock:
+                used = self.used.setdefault(user_id, result.scalar_one())
+        if used >= self.daily_limit:
+            raise HTTPException(status_code=429, detail="Daily token budget used up")
+
+    def spend(self, user_id, tokens):
+        with self.lock:
+            self._today()
+            if user_id in self.used:
+                self.used[user_id] += tokens
+
+token_budget = TokenBudget(config.DAILY_TOKEN_BUDGET)
@@ -0,0 +1,120 @@
+import importlib.util
+import threading
+import time
+import numpy as np
+
+from app.config import config, logger
+from app.lexical_index import tokenize
+
+class Reranker:
+    """Second retrieval stage: rescores first-stage candidates against the query.
+
+    Candidates are scored in batches in first-stage order until `budget`
+    seconds have passed. Scored candidates are reordered by score; any the
+    budget did not reach follow them in their first-stage order.
+    """
+
+    name = None
+
+    def __init__(self, budget, batch_size):
+        self.budget = budget
+        self.batch_size = batch_size
+        self.timeouts = 0
+
+    def load(self):
+        """Load any model weights now rather than on the first query"""
+
+    def score(self, query, texts):
+        """One relevance score per text, higher is better"""
+        raise NotImplementedError
+
+    def rerank(self, query, results, top_k):
+        if len(results) <= 1:
+            return results[:top_k]
+        deadline = time.perf_counter() + self.budget
+        scores = []
+        for start in range(0, len(results), self.batch_size):
+            if start and time.perf_counter() > deadline:
+                self.timeouts += 1
+                logger.warning(f"Reranking budget spent after {start} of {len(results)} candidates")
+                break
+            batch = results[start:start + self.batch_size]
+            scores.extend(self.score(query, [doc['text'] for doc in batch]))
+
+        scored = len(scores)
+        # Stable sort, so ties keep first-stage order
+        order = np.argsort(-np.asarray(scores, dtype=np.float32), kind="stable")
+        reranked = [{**results[i], 'score': float(scores[i])} for i in order[:top_k]]
+        return reranked + results[scored:scored + top_k - len(reranked)]
+
+class OverlapReranker(Reranker):
+    """Query term coverage, weighted by how rare each term is among the
+    candidates, plus a bonus for query word pairs that appear in order"""
+
+    name = "overlap"
+
+    def score(self, query, texts):
+        query_terms = list(dict.fromkeys(tokenize(query)))
+        if not query_terms:
+            return np.zeros(len(texts), dtype=np.float32)
+        query_pairs = list(dict.fromkeys(zip(query_terms, query_terms[1:])))
+
+        term_hits = np.zeros((len(texts), len(query_terms)), dtype=np.float32)
+        pair_hits = np.zeros((len(texts), max(len(query_pairs), 1)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            terms = tokenize(text)
+            present = set(terms)
+            term_hits[row] = [term in present for term in query_terms]
+            if query_pairs:
+                pairs = set(zip(terms, terms[1:]))
+                pair_hits[row, :len(query_pairs)] = [pair in pairs for pair in query_pairs]
+
+        df = term_hits.sum(axis=0)
+        idf = np.log1p(len(texts) / (df + 0.5))
+        coverage = term_hits @ idf / idf.sum()
+        phrase = pair_hits.mean(axis=1) if query_pairs else 0.0
+        return coverage + 0.5 * phrase
+
+class CrossEncoderReranker(Reranker):
+    """A sentence-transformers cross-encoder scoring (query, chunk) pairs on CPU.
+
+    The model is loaded on first use (or by load()), not at import, so
+    starting the app does not wait for torch and the model weights.
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, budget, batch_size, model_name):
+        super().__init__(budget, batch_size)
+        if importlib.util.find_spec("sentence_transformers") is None:
+            raise ImportError("sentence-transformers is not installed")
+        self.model_name = model_name
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                from sentence_transformers import CrossEncoder
+
+                start = time.perf_counter()
+                self.model = CrossEncoder(self.model_name, device="cpu")
+                logger.info(f"Loaded reranker {self.model_name} in {time.perf_counter() - start:.1f}s")
+            return self.model
+
+    def score(self, query, texts):
+        model = self.model or self.load()
+        return model.predict([(query, text) for text in texts], batch_size=self.batch_size)
+
+def get_reranker():
+    budget = config.RERANK_BUDGET_MS / 1000
+    if config.RERANKER == "none":
+        return None
+    if config.RERANKER == "cross-encoder":
+        try:
+            return CrossEncoderReranker(budget, config.RERANK_BATCH_SIZE, config.RERANK_MODEL)
+        except ImportError:
+            logger.warning("RERANKER is cross-encoder but sentence-transformers is not installed, using overlap reranker")
+    return OverlapReranker(budget, config.RERANK_BATCH_SIZE)
+
+reranker = get_reranker()
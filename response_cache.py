@@ -0,0 +1,110 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+from app.config import config
+from app.embeddings import embedder
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+def normalize_query(query):
+    return " ".join(PUNCTUATION_RE.sub(" ", query.lower()).split())
+
+class ResponseCache:
+    """LRU/TTL cache of chatbot answers.
+
+    Entries are keyed by user, normalised query, the chunk ids retrieved
+    for it and the conversation so far, since recent turns are part of the
+    prompt and a follow-up means something else in another session. On
+    an exact miss, earlier queries that retrieved the same chunks
+    are compared by embedding so paraphrases can hit too. Bumping a user's
+    generation invalidates all of their entries at once.
+    """
+
+    def __init__(self, max_entries, ttl, similarity):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.groups = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _group(self, user_id, context, history):
+        chunks = tuple(doc['metadata'].get('chunk_id') for doc in context or [])
+        turns = hash(tuple((turn["is_user"], turn["message"]) for turn in history)) if history else None
+        return (user_id, chunks, turns)
+
+    def get(self, user_id, query, context, history=None):
+        group = self._group(user_id, context, history)
+        key = (group, normalize_query(query))
+        now = time.monotonic()
+        with self.lock:
+            generation = self.generations.get(user_id, 0)
+            entry = self._live(key, now, generation)
+            if entry is None and self.similarity and self.groups.get(group):
+                entry = self._similar(group, query, now, generation)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Serving a stored answer costs no model tokens
+            return dict(entry[2], tokens_used=0)
+
+    def _live(self, key, now, generation):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now or entry[1] != generation:
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def _similar(self, group, query, now, generation):
+        keys = list(self.groups[group])
+        vectors = np.stack([self.entries[key][3] for key in keys])
+        scores = vectors @ embedder.embed([query])[0]
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        return self._live(keys[best], now, generation)
+
+    def put(self, user_id, query, context, response, history=None):
+        group = self._group(user_id, context, history)
+        key = (group, normalize_query(query))
+        vector = embedder.embed([query])[0] if self.similarity else None
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            generation = self.generations.get(user_id, 0)
+            self.entries[key] = (time.monotonic() + self.ttl, generation, response, vector)
+            self.groups.setdefault(group, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key):
+        del self.entries[key]
+        group = self.groups.get(key[0])
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self.groups[key[0]]
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+response_cache = ResponseCache(
+    config.RESPONSE_CACHE_SIZE,
+    config.RESPONSE_CACHE_TTL,
+    config.RESPONSE_CACHE_SIMILARITY
+)
@@ -0,0 +1,484 @@
+import base64
+import json
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+from app.config import logger
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking without fcntl; run a single writer process there
+    fcntl = None
+
+MANIFEST = "MANIFEST"
+ID_WIDTH = 64
+SUFFIXES = ("vec", "ids", "end", "txt", "key", "ord")
+
+def fsync_dir(path):
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_file(path, data):
+    """Replace a file with `data` once it is on disk"""
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def encode_ids(ids):
+    if any(len(embedding_id.encode()) > ID_WIDTH for embedding_id in ids):
+        raise ValueError(f"Embedding ids are limited to {ID_WIDTH} bytes")
+    return np.array([embedding_id.encode() for embedding_id in ids], dtype=f"S{ID_WIDTH}")
+
+class Segment:
+    """A run of entries stored column by column in four append-only files.
+
+    NNNNNN.vec  float32 vectors, one row per entry
+    NNNNNN.ids  embedding ids, ID_WIDTH bytes each
+    NNNNNN.end  uint64 end offset of each entry's text in NNNNNN.txt
+    NNNNNN.txt  UTF-8 chunk texts, back to back
+
+    Only the first `count` entries (and `text_bytes` of text) are part of
+    the segment; anything past them is an append that was never committed
+    to the manifest and is cut off before the next append. The files are
+    memory-mapped read-only, so searches read vectors straight from the
+    page cache without copying them.
+
+    Ids are found by binary search over a sorted copy of them (`keys`) and
+    the row each one came from (`order`). Once a segment is full, seal()
+    writes those to NNNNNN.key and NNNNNN.ord so they are memory-mapped
+    like the rest; until then they are kept in memory and new rows are
+    merged in as they are appended.
+    """
+
+    def __init__(self, directory, name, dim, count=0, text_bytes=0, alive=None):
+        self.directory = directory
+        self.name = name
+        self.dim = dim
+        self.count = None
+        self.indexed = 0
+        self.keys = np.empty(0, dtype=f"S{ID_WIDTH}")
+        self.order = np.empty(0, dtype=np.uint32)
+        self.update(count, text_bytes, alive)
+
+    def path(self, suffix):
+        return os.path.join(self.directory, f"{self.name}.{suffix}")
+
+    def update(self, count, text_bytes, alive=None):
+        """Take on the committed state a manifest gives for this segment"""
+        self.alive = alive if alive is not None else np.ones(count, dtype=bool)
+        if count == self.count and text_bytes == self.text_bytes:
+            return
+        if count < self.indexed:
+            # Rows this process appended were never committed
+            self.indexed = 0
+            self.keys = np.empty(0, dtype=f"S{ID_WIDTH}")
+            self.order = np.empty(0, dtype=np.uint32)
+        self.count = count
+        self.text_bytes = text_bytes
+        self._map()
+
+    def _map(self):
+        if self.count:
+            self.vectors = np.memmap(self.path("vec"), dtype=np.float32, mode="r", shape=(self.count, self.dim))
+            self.ids = np.memmap(self.path("ids"), dtype=f"S{ID_WIDTH}", mode="r", shape=(self.count,))
+            self.ends = np.memmap(self.path("end"), dtype=np.uint64, mode="r", shape=(self.count,))
+        else:
+            self.vectors = np.empty((0, self.dim), dtype=np.float32)
+            self.ids = np.empty(0, dtype=f"S{ID_WIDTH}")
+            self.ends = np.empty(0, dtype=np.uint64)
+        if self.text_bytes:
+            self.text = np.memmap(self.path("txt"), dtype=np.uint8, mode="r", shape=(self.text_bytes,))
+        else:
+            self.text = np.empty(0, dtype=np.uint8)
+        if self.count and not self.indexed:
+            self._map_index()
+
+    def _map_index(self):
+        """Use the sealed id index if there is one covering exactly the committed rows"""
+        try:
+            key_size = os.path.getsize(self.path("key"))
+            order_size = os.path.getsize(self.path("ord"))
+        except OSError:
+            return
+        if key_size != self.count * ID_WIDTH or order_size != self.count * 4:
+            return
+        self.keys = np.memmap(self.path("key"), dtype=f"S{ID_WIDTH}", mode="r", shape=(self.count,))
+        self.order = np.memmap(self.path("ord"), dtype=np.uint32, mode="r", shape=(self.count,))
+        self.indexed = self.count
+
+    def _index(self):
+        """Merge rows appended since the id index was last brought up to date"""
+        if self.indexed == self.count:
+            return
+        new_order = np.argsort(self.ids[self.indexed:self.count], kind="stable").astype(np.uint32) + self.indexed
+        new_keys = self.ids[new_order]
+        if self.indexed:
+            at = np.searchsorted(self.keys, new_keys, side="right")
+            self.keys = np.insert(self.keys, at, new_keys)
+            self.order = np.insert(self.order, at, new_order)
+        else:
+            self.keys = np.asarray(new_keys)
+            self.order = new_order
+        self.indexed = self.count
+
+    def seal(self):
+        """Write the id index next to the data; called once the segment takes no more rows"""
+        self._index()
+        write_file(self.path("key"), self.keys.tobytes())
+        write_file(self.path("ord"), self.order.tobytes())
+        self.indexed = 0
+        self._map_index()
+
+    def find(self, keys):
+        """Row of the live entry for each encoded id, or -1"""
+        self._index()
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if not self.indexed:
+            return rows
+        first = np.searchsorted(self.keys, keys, side="left")
+        last = np.searchsorted(self.keys, keys, side="right")
+        for i in np.flatnonzero(last > first):
+            # An id replaced within this segment has several rows, one at most alive
+            for position in range(first[i], last[i]):
+                row = self.order[position]
+                if self.alive[row]:
+                    rows[i] = row
+                    break
+        return rows
+
+    def ids_with_prefix(self, prefix):
+        self._index()
+        prefix = prefix.encode()
+        # 0xff never occurs in UTF-8, so it sorts after every id with the prefix
+        first, last = np.searchsorted(self.keys, [prefix, prefix + b"\xff"])
+        rows = self.order[first:last]
+        rows = rows[self.alive[rows]]
+        return [embedding_id.decode() for embedding_id in self.ids[np.sort(rows)]]
+
+    @property
+    def live(self):
+        return int(self.alive.sum())
+
+    def text_at(self, row):
+        start = int(self.ends[row - 1]) if row else 0
+        return self.text[start:int(self.ends[row])].tobytes().decode("utf-8")
+
+    def append(self, ids, vectors, texts):
+        """Write entries after the committed ones; they count once the manifest is committed"""
+        encoded_ids = encode_ids(ids)
+        blobs = [(text or "").encode("utf-8") for text in texts]
+        ends = self.text_bytes + np.cumsum([len(blob) for blob in blobs], dtype=np.uint64)
+        columns = {
+            "vec": (self.count * self.dim * 4, np.ascontiguousarray(vectors, dtype=np.float32).tobytes()),
+            "ids": (self.count * ID_WIDTH, encoded_ids.tobytes()),
+            "end": (self.count * 8, ends.tobytes()),
+            "txt": (self.text_bytes, b"".join(blobs))
+        }
+        for suffix, (committed, data) in columns.items():
+            with open(self.path(suffix), "ab") as f:
+                f.truncate(committed)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.count += len(ids)
+        self.text_bytes = int(ends[-1]) if len(ends) else self.text_bytes
+        self.alive = np.concatenate([self.alive, np.ones(len(ids), dtype=bool)])
+        self._map()
+
+    def describe(self):
+        entry = {"name": self.name, "count": self.count, "text_bytes": self.text_bytes}
+        if not self.alive.all():
+            entry["dead"] = base64.b64encode(np.packbits(~self.alive).tobytes()).decode()
+        return entry
+
+    @staticmethod
+    def alive_rows(entry):
+        """The live-row mask a manifest entry describes"""
+        alive = np.ones(entry["count"], dtype=bool)
+        if entry.get("dead"):
+            dead = np.frombuffer(base64.b64decode(entry["dead"]), dtype=np.uint8)
+            alive &= ~np.unpackbits(dead, count=entry["count"]).astype(bool)
+        # Manifests written before deletions were stored as a bitmap
+        alive[entry.get("deleted", [])] = False
+        return alive
+
+    def remove_files(self):
+        for suffix in SUFFIXES:
+            try:
+                os.remove(self.path(suffix))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # Windows will not delete a file another process has mapped
+                logger.warning(f"Could not remove {self.path(suffix)}: {e}")
+
+class SegmentStore:
+    """Append-only, memory-mapped store of (embedding id, vector, text) entries.
+
+    Entries are appended to the last segment until it holds `max_rows`,
+    then a new segment is started. Deleting an entry only marks it in the
+    manifest; compact() rewrites the live entries into fresh segments once
+    enough of the store is dead.
+
+    MANIFEST lists the segments with their committed lengths and a bitmap
+    of their deleted rows. It is replaced atomically after the data it
+    describes has been fsynced, so a crash leaves either the old or the new
+    state. Other processes pick up a new manifest on their next call,
+    reopening only segments they have not seen, and writers take an flock,
+    so several workers can share one store and one page-cache copy of it.
+    """
+
+    def __init__(self, directory, dim, max_rows):
+        self.directory = directory
+        self.dim = dim
+        self.max_rows = max_rows
+        self.segments = []
+        self.next_name = 1
+        self.version = None
+        self.lock = threading.RLock()
+        self.refresh()
+
+    def _manifest_path(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self._manifest_path())
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """Re-read the manifest if another process (or thread) committed a new one"""
+        with self.lock:
+            version = self._stat()
+            if version == self.version:
+                return
+            if version is None:
+                self.segments = []
+                self.next_name = 1
+            else:
+                with open(self._manifest_path()) as f:
+                    manifest = json.load(f)
+                if manifest["dim"] != self.dim:
+                    raise ValueError(f"{self.directory} holds {manifest['dim']}-dimensional vectors, not {self.dim}")
+                # Segments already open keep their mappings and id index; only new rows are indexed
+                opened = {segment.name: segment for segment in self.segments}
+                segments = []
+                for entry in manifest["segments"]:
+                    alive = Segment.alive_rows(entry)
+                    segment = opened.get(entry["name"])
+                    if segment is None:
+                        segment = Segment(self.directory, entry["name"], self.dim, entry["count"], entry["text_bytes"], alive)
+                    else:
+                        segment.update(entry["count"], entry["text_bytes"], alive)
+                    segments.append(segment)
+                self.segments = segments
+                self.next_name = manifest["next"]
+            self.version = version
+
+    @contextmanager
+    def _writing(self):
+        with self.lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if fcntl is None:
+                    self.refresh()
+                    yield
+                    return
+                with open(os.path.join(self.directory, "LOCK"), "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    try:
+                        self.refresh()
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+            except BaseException:
+                # Drop whatever was changed in memory but not committed
+                self.version = None
+                raise
+
+    def _commit(self):
+        manifest = {
+            "dim": self.dim,
+            "next": self.next_name,
+            "segments": [segment.describe() for segment in self.segments]
+        }
+        path = self._manifest_path()
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        fsync_dir(self.directory)
+        self.version = self._stat()
+
+    def _new_segment(self):
+        segment = Segment(self.directory, f"{self.next_name:06d}", self.dim)
+        # No manifest has this name yet, so any files under it were left by a crash
+        segment.remove_files()
+        self.next_name += 1
+        return segment
+
+    def _locate(self, ids):
+        """(segment, row) of each id's live entry, or None"""
+        keys = encode_ids(ids)
+        locations = [None] * len(ids)
+        for segment in self.segments:
+            rows = segment.find(keys)
+            for i in np.flatnonzero(rows >= 0):
+                locations[i] = (segment, int(rows[i]))
+        return locations
+
+    def __len__(self):
+        with self.lock:
+            self.refresh()
+            return sum(segment.live for segment in self.segments)
+
+    def dead_ratio(self):
+        with self.lock:
+            total = sum(segment.count for segment in self.segments)
+            return 1 - sum(segment.live for segment in self.segments) / total if total else 0.0
+
+    def add(self, ids, vectors, texts=None):
+        """Append entries; an id that is already stored is replaced"""
+        if not ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        texts = texts if texts is not None else [None] * len(ids)
+        if len(set(ids)) < len(ids):
+            # The last of several entries for one id wins
+            keep = sorted({embedding_id: i for i, embedding_id in enumerate(ids)}.values())
+            ids = [ids[i] for i in keep]
+            vectors = vectors[keep]
+            texts = [texts[i] for i in keep]
+        with self._writing():
+            for location in self._locate(ids):
+                if location is not None:
+                    location[0].alive[location[1]] = False
+
+            start = 0
+            while start < len(ids):
+                if not self.segments or self.segments[-1].count >= self.max_rows:
+                    if self.segments:
+                        self.segments[-1].seal()
+                    self.segments.append(self._new_segment())
+                segment = self.segments[-1]
+                end = min(len(ids), start + self.max_rows - segment.count)
+                segment.append(ids[start:end], vectors[start:end], texts[start:end])
+                start = end
+            self._commit()
+
+    def remove(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        with self._writing():
+            removed = 0
+            for location in self._locate(ids):
+                if location is not None and location[0].alive[location[1]]:
+                    location[0].alive[location[1]] = False
+                    removed += 1
+            if removed:
+                self._commit()
+
+    def ids(self, prefix=""):
+        with self.lock:
+            self.refresh()
+            return [embedding_id for segment in self.segments for embedding_id in segment.ids_with_prefix(prefix)]
+
+    def texts(self, ids):
+        """Stored text by embedding id, for the ids that are present"""
+        ids = list(ids)
+        with self.lock:
+            self.refresh()
+            if not ids:
+                return {}
+            return {
+                embedding_id: location[0].text_at(location[1])
+                for embedding_id, location in zip(ids, self._locate(ids))
+                if location is not None
+            }
+
+    def search(self, queries, top_k):
+        """Top-k (embedding_id, score) lists for a batch of unit-length query vectors"""
+        with self.lock:
+            self.refresh()
+            candidates = []
+            for segment in self.segments:
+                live = segment.live
+                if not live:
+                    continue
+                scores = queries @ segment.vectors.T
+                if live < segment.count:
+                    scores[:, ~segment.alive] = -np.inf
+                k = min(top_k, live)
+                if k < segment.count:
+                    rows = np.argpartition(scores, segment.count - k, axis=1)[:, segment.count - k:]
+                else:
+                    rows = np.broadcast_to(np.arange(segment.count), scores.shape)
+                candidates.append((segment, rows, np.take_along_axis(scores, rows, axis=1)))
+            if not candidates:
+                return [[] for _ in range(len(queries))]
+
+            scores = np.concatenate([top_scores for _, _, top_scores in candidates], axis=1)
+            rows = np.concatenate([top_rows for _, top_rows, _ in candidates], axis=1)
+            owners = np.concatenate([
+                np.full(top_rows.shape[1], i) for i, (_, top_rows, _) in enumerate(candidates)
+            ])
+            order = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+            results = []
+            for query, picks in enumerate(order):
+                hits = []
+                for pick in picks:
+                    score = scores[query, pick]
+                    if score == -np.inf:
+                        break
+                    segment = candidates[owners[pick]][0]
+                    hits.append((segment.ids[rows[query, pick]].decode(), float(score)))
+                results.append(hits)
+            return results
+
+    def compact(self):
+        """Rewrite live entries into new segments and drop the old ones"""
+        with self._writing():
+            old = self.segments
+            known = {segment.name for segment in old}
+            self._remove_orphans(known)
+            fresh = []
+            for segment in old:
+                rows = np.flatnonzero(segment.alive)
+                for start in range(0, len(rows), self.max_rows):
+                    batch = rows[start:start + self.max_rows]
+                    if not fresh or fresh[-1].count + len(batch) > self.max_rows:
+                        fresh.append(self._new_segment())
+                    fresh[-1].append(
+                        [segment.ids[row].decode() for row in batch],
+                        segment.vectors[batch],
+                        [segment.text_at(row) for row in batch]
+                    )
+            for segment in fresh[:-1]:
+                segment.seal()
+            self.segments = fresh
+            self._commit()
+            for segment in old:
+                segment.remove_files()
+            logger.info(f"Compacted {self.directory}: {sum(s.count for s in old)} entries down to {sum(s.count for s in fresh)}")
+
+    def _remove_orphans(self, known):
+        """Delete segment files no manifest refers to, left by a crash mid-compaction"""
+        for name in os.listdir(self.directory):
+            stem, _, suffix = name.partition(".")
+            if suffix in SUFFIXES and stem.isdigit() and stem not in known and int(stem) >= self.next_name:
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,31 @@
+import ast
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(data):
+    """Encode to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def decode_sources(value):
+    """Decode ChatHistory.source_documents.
+
+    Rows are stored as JSON; older rows hold a Python repr of the list,
+    which is parsed as a literal rather than evaluated.
+    """
+    if not value:
+        return []
+    try:
+        return loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
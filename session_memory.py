@@ -0,0 +1,48 @@
+import threading
+from collections import OrderedDict, deque
+
+from app.config import config
+
+class SessionMemory:
+    """Ring buffer of the most recent turns of each chat session.
+
+    Lets a chat turn build its chat_history without a database round trip.
+    Sessions not seen by this process return None and are loaded from the
+    database once. Least recently used sessions are dropped past
+    max_sessions.
+    """
+
+    def __init__(self, max_sessions, turns):
+        self.max_sessions = max_sessions
+        self.turns = turns
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, session_id):
+        with self.lock:
+            turns = self.sessions.get((user_id, session_id))
+            if turns is None:
+                return None
+            self.sessions.move_to_end((user_id, session_id))
+            return list(turns)
+
+    def load(self, user_id, session_id, messages):
+        with self.lock:
+            self.sessions[(user_id, session_id)] = deque(messages, maxlen=self.turns)
+            self._evict()
+
+    def append(self, user_id, session_id, *messages):
+        with self.lock:
+            turns = self.sessions.get((user_id, session_id))
+            if turns is None:
+                # Evicted since it was loaded; the next turn reloads it from the database
+                return
+            turns.extend(messages)
+            self.sessions.move_to_end((user_id, session_id))
+            self._evict()
+
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+session_memory = SessionMemory(config.SESSION_MEMORY_SESSIONS, config.SESSION_MEMORY_TURNS)
@@ -0,0 +1,229 @@
+import atexit
+import contextvars
+import importlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import zlib
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking without fcntl; run a single server process there
+    fcntl = None
+
+TEXT_FORMAT = '%(asctime)s - %(message)s'
+
+# Per-request fields added to every record logged while handling it.
+# The dict is shared with tasks and threads spawned by the request, so
+# the user id and stage timings they add are seen by the access log.
+log_context = contextvars.ContextVar("log_context", default=None)
+
+listener = None
+queue_handler = None
+handlers = []
+# Set in pool worker processes, which leave the log file to the process serving requests
+worker_process = False
+
+def start_request(request_id):
+    context = {"request_id": request_id, "user_id": None, "stages": {}}
+    log_context.set(context)
+    return context
+
+def set_user(user_id):
+    context = log_context.get()
+    if context is not None:
+        context["user_id"] = user_id
+
+def add_stage(stage, seconds):
+    context = log_context.get()
+    if context is not None:
+        stages = context["stages"]
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a queue for a listener thread to write.
+
+    The request context is copied onto the record here, on the calling
+    thread, because the listener has none. When the queue is full the
+    record is dropped and counted; logging never blocks the caller.
+    """
+
+    def __init__(self, target):
+        super().__init__(target)
+        self.dropped = 0
+
+    def prepare(self, record):
+        context = log_context.get()
+        if context is not None:
+            record.request_id = context["request_id"]
+            record.user_id = context["user_id"]
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class DebugSampler(logging.Filter):
+    """Lets through `rate` of DEBUG records and everything above DEBUG.
+
+    Within a request the choice is made from the request id, so a sampled
+    request keeps all of its debug lines.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.threshold = int(rate * 2 ** 32)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        context = log_context.get()
+        if context is not None:
+            return zlib.crc32(context["request_id"].encode()) < self.threshold
+        return random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed as extra={"fields": {...}} are merged in"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for field in ("request_id", "user_id"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.processName != "MainProcess":
+            entry["process"] = record.processName
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class SharedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler for a file every server process writes (uvicorn
+    --workers or reload).
+
+    Each record is written, and the file rolled over, under an flock on
+    <file>.lock, so one process rotates at a time. The file is reopened
+    first if another process rotated it, so no line lands in a file that
+    was renamed away.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        # Kept open for the handler's lifetime: like the log file itself, a
+        # closed handler may still be asked to emit and has to reopen it
+        self.lock_file = open(self.baseFilename + ".lock", "a")
+
+    def emit(self, record):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            if self.stream is not None and self._rotated_elsewhere():
+                self.stream.close()
+                self.stream = None
+            super().emit(record)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _rotated_elsewhere(self):
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+def _install(target, sample_rate):
+    global queue_handler
+    queue_handler = ContextQueueHandler(target)
+    queue_handler.addFilter(DebugSampler(sample_rate))
+    logging.getLogger().handlers[:] = [queue_handler]
+
+def setup_logging(config):
+    """Send all records through a queue to a listener thread that does the I/O.
+
+    A server process writes JSON lines to a size-rotated file, shared
+    with any other server processes, plus plain text to stderr. Pool
+    workers only write to stderr unless forward_to() sends their records
+    to the server process.
+    """
+    global listener
+    stop_logging()
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handlers[:] = [console]
+    if not worker_process:
+        os.makedirs(config.LOG_DIR, exist_ok=True)
+        file_handler = SharedRotatingFileHandler if fcntl is not None else logging.handlers.RotatingFileHandler
+        log_file = file_handler(
+            os.path.join(config.LOG_DIR, config.LOG_FILE),
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUPS,
+            encoding="utf-8",
+            delay=True
+        )
+        log_file.setFormatter(JsonFormatter())
+        handlers.append(log_file)
+
+    # Neither format uses the caller's file and line or the thread name,
+    # so skip looking them up for every record
+    logging._srcfile = None
+    logging.logThreads = False
+
+    records = queue.Queue(config.LOG_QUEUE_SIZE)
+    logging.getLogger().setLevel(config.LOG_LEVEL)
+    _install(records, config.LOG_DEBUG_SAMPLE)
+    listener = logging.handlers.QueueListener(records, *handlers)
+    listener.start()
+
+def init_pool_worker(initializer=None, *args):
+    """Initializer for process pools: marks the process as a worker, then runs
+    `initializer`, given as "module:function".
+
+    The name is imported only after the flag is set, since importing the
+    app configures logging. A server started by uvicorn with reload or
+    several workers is a child process too, so that cannot be the test.
+    """
+    global worker_process
+    worker_process = True
+    if initializer:
+        module, function = initializer.split(":")
+        getattr(importlib.import_module(module), function)(*args)
+
+def listen(source):
+    """Write records arriving on `source` (from forward_to in a child) with this process's handlers"""
+    source_listener = logging.handlers.QueueListener(source, *handlers)
+    source_listener.start()
+    return source_listener
+
+def forward_to(target, sample_rate):
+    """In a child process: put records on `target`, a multiprocessing queue, instead of writing them"""
+    stop_logging()
+    _install(target, sample_rate)
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+atexit.register(stop_logging)
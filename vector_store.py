@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import numpy as np
+
+from app.config import config, logger
+from app.segment_store import SegmentStore
+
+class VectorIndex:
+    """Vector index keyed by DocumentChunk.embedding_id, partitioned per user.
+
+    Each user's vectors and chunk texts live in a SegmentStore under
+    <path>/<user_id>/. The segments are memory-mapped, so uvicorn workers
+    on one host search the same page-cache copy instead of each holding
+    the index in its own heap.
+    """
+
+    def __init__(self, path, dim, segment_rows=None, compact_ratio=None):
+        self.path = path
+        self.dim = dim
+        self.segment_rows = segment_rows or config.VECTOR_SEGMENT_ROWS
+        self.compact_ratio = config.VECTOR_COMPACT_RATIO if compact_ratio is None else compact_ratio
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def partition(self, user_id, create=True):
+        """The user's store, opened the first time it is asked for"""
+        partition = self.partitions.get(user_id)
+        if partition is not None:
+            return partition
+        with self.lock:
+            partition = self.partitions.get(user_id)
+            if partition is None:
+                directory = os.path.join(self.path, str(user_id))
+                if os.path.isdir(directory) or self._migrate(user_id, directory) or create:
+                    partition = SegmentStore(directory, self.dim, self.segment_rows)
+                    self.partitions[user_id] = partition
+            return partition
+
+    def add(self, user_id, ids, vectors, texts=None):
+        if ids:
+            self.partition(user_id).add(ids, vectors, texts)
+
+    def remove(self, user_id, ids):
+        partition = self.partition(user_id, create=False)
+        if partition is not None and ids:
+            partition.remove(ids)
+
+    def ids(self, user_id, prefix=""):
+        partition = self.partition(user_id, create=False)
+        return partition.ids(prefix) if partition is not None else []
+
+    def texts(self, user_id, ids):
+        """Chunk texts kept alongside the vectors, by embedding id"""
+        partition = self.partition(user_id, create=False)
+        return partition.texts(ids) if partition is not None else {}
+
+    def search(self, user_id, queries, top_k=3):
+        """Top-k (embedding_id, score) lists for a batch of unit-length query vectors"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        partition = self.partition(user_id, create=False)
+        if partition is None:
+            return [[] for _ in range(len(queries))]
+        return partition.search(queries, top_k)
+
+    def save(self, user_id):
+        """Every write is already durable; this only compacts a store that is mostly deleted rows"""
+        partition = self.partitions.get(user_id)
+        if partition is not None and partition.dead_ratio() > self.compact_ratio:
+            partition.compact()
+
+    def _migrate(self, user_id, directory):
+        """Move a partition saved as <user_id>.npy + .ids.json into a segment store"""
+        base = os.path.join(self.path, str(user_id))
+        matrix_file, ids_file = base + ".npy", base + ".ids.json"
+        if not os.path.exists(ids_file):
+            return False
+        with open(ids_file) as f:
+            ids = json.load(f)
+        vectors = np.load(matrix_file, mmap_mode="r") if ids else None
+        if vectors is not None and vectors.shape != (len(ids), self.dim):
+            logger.error(f"Vector index for user {user_id} is out of sync, skipping")
+            return False
+        # Texts stay in the database for these chunks
+        SegmentStore(directory, self.dim, self.segment_rows).add(ids, vectors)
+        os.remove(ids_file)
+        if os.path.exists(matrix_file):
+            os.remove(matrix_file)
+        logger.info(f"Migrated vector index for user {user_id}: {len(ids)} vectors")
+        return True
+
+    def load(self):
+        """Open every saved partition now rather than on first use"""
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.path):
+            user_id = name[:-len(".ids.json")] if name.endswith(".ids.json") else name
+            if user_id.isdigit():
+                self.partition(int(user_id), create=False)
+        logger.info(f"Loaded vector index for {len(self.partitions)} users")
+
+vector_index = VectorIndex(config.VECTOR_DIR, config.EMBEDDING_DIM)